@@ -0,0 +1,136 @@
+import threading
+import logging
+import re
+
+import numpy as np
+
+from time import time
+
+
+class AdmissionController(object):
+    '''
+    Decides which incoming statuses enter the pipeline when the stream
+    delivers more than the text processor can handle.
+
+    The load of the pipeline is the utilization of the text processor the
+    arriving statuses would cause: processing latency times arrival rate. It
+    is estimated from the admitted statuses, their rate divided by the share
+    of statuses currently admitted (all exponentially smoothed), so shedding
+    lowers the rate the text processor sees but not the estimated load. Up to
+    a load of 1 every status is admitted. Above, statuses are admitted with
+    probability 1 / load, so the admitted statuses keep the text processor at
+    capacity. The probability further depends on the shedding policy:
+
+    - 'uniform': all statuses are admitted with the same probability
+    - 'priority': statuses containing one of the high weight tokens of the
+      current model of any topic (see `set_priority_tokens()`) are always
+      admitted
+    - 'retweets': retweets are shed before original statuses
+
+    Admitted statuses get a field `sampling_weight` (inverse admission
+    probability), the number of arriving statuses each of them stands for.
+    Shed statuses are counted in `shed`, statuses dropped because
+    `queues['text_processing']` was full in `overflow`.
+
+    Arguments:
+    ---------------
+    policy: str, one of 'uniform', 'priority', 'retweets'
+    min_keep: float, lower bound of the admission probability
+    smoothing: float, weight of new observations in the moving averages
+    '''
+
+    policies = ['uniform', 'priority', 'retweets']
+    _token_pattern = re.compile(r'[#@]?\w+')
+
+    def __init__(self, policy='uniform', min_keep=0.01, smoothing=0.05):
+        if policy not in self.policies:
+            raise ValueError(f'Unknown shedding policy: {policy}')
+        self.policy = policy
+        self.min_keep = min_keep
+        self.smoothing = smoothing
+        self.lock = threading.Lock()
+        self.priority_tokens = set()
+        # topic -> high weight tokens of its model
+        self.topic_tokens = {}
+        # Smoothed time between admitted statuses
+        self.interarrival = None
+        self.last_admission = None
+        # Smoothed share of arriving statuses that are admitted
+        self.keep = 1.0
+        self.latency = 0
+        self.shed = {'track': 0, 'sample': 0}
+        self.overflow = {'track': 0, 'sample': 0}
+        self.shedding = False
+
+    def set_priority_tokens(self, tokens, topic=None):
+        '''Set the tokens that mark statuses as high priority for a topic'''
+        self.topic_tokens[topic] = set(t.lower() for t in tokens)
+        self.priority_tokens = set().union(*self.topic_tokens.values())
+
+    def observe_latency(self, seconds):
+        '''Record the processing time of one status in the text processor'''
+        self.latency += self.smoothing * (seconds - self.latency)
+
+    def load(self):
+        '''Current load of the pipeline. 1 means running at capacity'''
+        if not self.interarrival:
+            return 0
+        # Utilization by the admitted statuses, scaled up to all arrivals
+        return self.latency / self.interarrival / self.keep
+
+    def keep_probability(self, status, load):
+        '''Probability to admit `status` at the given load'''
+        if load <= 1:
+            return 1.0
+        # The pipeline can process 1 / load of the arrivals
+        p = 1 / load
+
+        if self.policy == 'priority':
+            tokens = self._token_pattern.findall(status.text.lower())
+            if not self.priority_tokens.isdisjoint(tokens):
+                p = 1.0
+        elif self.policy == 'retweets':
+            if status.retweeted_id is not None:
+                p = p**2
+            else:
+                p = np.sqrt(p)
+
+        return min(1.0, max(self.min_keep, p))
+
+    def admit(self, status):
+        '''
+        Decide if a status enters the pipeline. Sets `sampling_weight` on
+        admitted statuses.
+
+        Returns bool
+        '''
+        now = time()
+        with self.lock:
+            load = self.load()
+            p = self.keep_probability(status, load)
+            self.keep += self.smoothing * (p - self.keep)
+            shedding = p < 1
+            if shedding != self.shedding:
+                logging.info(f'Load shedding {"on" if shedding else "off"} '
+                             f'(load: {round(load, 2)})')
+                self.shedding = shedding
+
+            if p < 1 and np.random.random() >= p:
+                self.shed[status['sample']] += 1
+                return False
+
+            if self.last_admission is not None:
+                dt = now - self.last_admission
+                if self.interarrival is None:
+                    self.interarrival = dt
+                else:
+                    self.interarrival += self.smoothing * (dt - self.interarrival)
+            self.last_admission = now
+
+        status['sampling_weight'] = 1 / p
+        return True
+
+    def record_overflow(self, status):
+        '''Count a status that was dropped because the queue was full'''
+        with self.lock:
+            self.overflow[status['sample']] += 1
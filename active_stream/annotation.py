@@ -5,39 +5,60 @@ import pymongo
 
 import numpy as np
 
-from time import sleep
+from time import time
+from transport import put_latest
 
 class Annotator(threading.Thread):
     '''
     Handles manual annotations.
 
-    Queries database for uncertain statuses, presents and presents them to the
-    user.     
-    
+    Queries the database of a topic for uncertain statuses, leases them to the
+    connected annotation sessions and presents them to the users. Each session
+    holds at most one lease at a time. Leases that are not answered within
+    `lease_timeout` seconds expire and the status is returned to the pool of
+    work, so several users can annotate in parallel without duplicating work.
+
+    A share `explore_share` of the leases is reserved for statuses the
+    prefilter rejected but that were processed for exploration (see
+    `classification.Prefilter`), if there are any.
+
+    Responses are read from `queues['annotation_response']` as dicts of the
+    form `{'session': <socket.io sid>, 'tweet_id': <str>, 'response': <str>}`
+    where response is one of 'relevant', 'irrelevant', 'skip', 'refresh',
+    'connect' or 'disconnect'.
+
     Arguments:
-    ---------------  
-    database: pymongo connection
-    train_event: threading event. To communicate with Trainer
+    ---------------
+    data: data structures, see app.py for details
     train_threshold: int, number of annotations (for each class) before training
         starts.
-    
+    lease_timeout: float, seconds before an unanswered lease expires.
+    poll_interval: float, seconds between database queries for sessions that
+        are waiting for work.
+    explore_share: float, share of the leases for prefilter exploration
+        statuses.
+
     Methods:
-    ---------------  
+    ---------------
     run
 
     '''
 
-    def __init__(self, data, train_threshold=1):
-        super(Annotator, self).__init__(name='Annotator')
+    def __init__(self, data, train_threshold=1, lease_timeout=120,
+                 poll_interval=0.5, explore_share=0.1):
+        super(Annotator, self).__init__(name=f'Annotator/{data["topic"]}')
         self.database = data['database']
         self.train = data['events']['train_model']
         self.stoprequest = threading.Event()
         self.n_positive = False
         self.n_negative = False
         self.train_threshold = train_threshold
+        self.lease_timeout = lease_timeout
+        self.poll_interval = poll_interval
+        self.explore_share = explore_share
         self.annotation_response = data['queues']['annotation_response']
         self.socket = data['socket']
-        self.annotated_text = {}
+        self.namespace = data['namespace']
         self.message_queue = data['queues']['messages']
         self.n_trainer_triggered = 0
         self.clf_performance = {
@@ -46,99 +67,212 @@ class Annotator(threading.Thread):
                 'false_positive': 0,
                 'false_negative': 0
                 }
-        self.first = True
-        
+        # sid -> {'status': leased status or None, 'eval': bool,
+        #         'waiting': bool, 'next_poll': float}
+        self.sessions = {}
 
     def run(self):
         logging.debug('Ready!')
         while not self.stoprequest.isSet():
-            # Every third annotation is an evaluation run
-            eval_run = np.random.choice([True, False], size=1, p=[0.3,0.7])[0]
-
-            # Look for work:
-            not_annotated = self.database.find({'manual_relevant': None,
-                                                'probability_relevant': {
-                                                    '$ne': None
-                                                    }})
-            
-            # If no work, wait and try again
-            if not_annotated.count() == 0:
-                if self.first:
-                    self.socket.emit('display_tweet', {'tweet_id': 'waiting'})
-                    self.first = False
-                sleep(0.05)
-                continue
-            
-            if not eval_run:
-                work = not_annotated.sort('annotation_priority', 
-                                          pymongo.ASCENDING).limit(1)
+            try:
+                message = self.annotation_response.get(timeout=0.05)
+                self.handle_response(message)
+            except queue.Empty:
+                pass
+
+            now = time()
+            for sid, session in list(self.sessions.items()):
+                if session['status'] is None and session['next_poll'] <= now:
+                    self.assign(sid, session)
+
+        logging.debug('Stopped.')
+
+    def handle_response(self, message):
+        '''
+        Process a message from an annotation session.
+
+        message: dict, see class docstring for format.
+        '''
+        sid = message['session']
+        response = message['response']
+        logging.debug(f'Received response {response} from session {sid}')
+
+        if response == 'connect':
+            self.sessions[sid] = {'status': None, 'eval': False,
+                                  'waiting': False, 'next_poll': 0}
+            return
+
+        session = self.sessions.get(sid)
+        if session is None:
+            logging.debug(f'Response from unknown session {sid}')
+            return
+
+        if response == 'disconnect':
+            self.release(session)
+            del self.sessions[sid]
+            return
+
+        status = session['status']
+        if response == 'refresh':
+            if status is not None:
+                self.display(sid, session)
             else:
-                work = not_annotated.limit(1)
-            
-            for status in work:
-                if self.annotation_response.full():
-                    self.annotation_response.get()
-                id_ = str(status['id'])
-                guess = str(round(status['probability_relevant'], 3))
-                logging.debug(f'Sending tweet for annotation. Id: {id_}'
-                              f'evaluation: {eval_run}')
-                self.socket.emit('display_tweet', {'tweet_id': id_,
-                                                   'guess': guess,
-                                                   'eval': str(eval_run)})
-                if eval_run:
-                    p = round(status['probability_relevant'], 2)
-                    self.message_queue.put('This is an evaluation Tweet '
+                session['waiting'] = False
+            return
+
+        if status is None or str(status['id']) != message.get('tweet_id'):
+            logging.debug(f'Response for tweet {message.get("tweet_id")} '
+                          f'does not match lease of session {sid}')
+            return
+
+        if response == 'relevant':
+            out = True
+        elif response == 'irrelevant':
+            out = False
+        elif response == 'skip':
+            out = -1
+        else:
+            logging.debug(f'Invalid response: {response}')
+            return
+
+        session['status'] = None
+        session['waiting'] = False
+        session['next_poll'] = 0
+
+        # Update record in DB. Only the lease holder may annotate, if the
+        # lease has been taken over by another session this is a no-op.
+        logging.debug('updating DB')
+        msg = self.database.update(
+                {'_id': status['_id'], 'lease_owner': sid},
+                {'$set': {'manual_relevant': out,
+                          'probability_relevant': int(out),
+                          'annotation_priority': None,
+                          'clf_version': float('inf'),
+                          'classified_at': time(),
+                          'lease_owner': None,
+                          'lease_expires': None}}
+                )
+        if msg['n'] == 0:
+            logging.debug(f'Lease on {status["id"]} expired before response')
+            return
+        self.database.update_many(
+                {'duplicate_of': status['id']},
+                {'$set': {'manual_relevant': out,
+                          'probability_relevant': int(out),
+                          'annotation_priority': None,
+                          'clf_version': float('inf'),
+                          'classified_at': time()}})
+
+        # Only annotations that were stored are counted
+        if out is True:
+            self.n_positive += 1
+        elif out is False:
+            self.n_negative += 1
+
+        # Evaluate classifier
+        if self.n_trainer_triggered > 0 and session['eval'] and out != -1:
+            guess = bool(round(status['probability_relevant'], 0))
+            self.clf_performance[self.evaluate_guess(guess, out)] += 1
+
+        # Trigger trainer if necessary
+        logging.debug('triggering trainer')
+        threshold = (self.n_trainer_triggered+1) * self.train_threshold
+        if (self.n_positive > threshold): #and
+            #self.n_negative > threshold):
+            self.train.set()
+            self.n_trainer_triggered += 1
+
+    def assign(self, sid, session):
+        '''
+        Lease the next status to a session and display it. If there is no work
+        available the session is told to wait.
+        '''
+        # Every third annotation is an evaluation run
+        eval_run = np.random.choice([True, False], size=1, p=[0.3,0.7])[0]
+        explore_run = np.random.random() < self.explore_share
+        status = self.lease(sid, eval_run, explore_run)
+
+        if status is None:
+            if not session['waiting']:
+                self.socket.emit('display_tweet', {'tweet_id': 'waiting'},
+                                 room=sid, namespace=self.namespace)
+                session['waiting'] = True
+            session['next_poll'] = time() + self.poll_interval
+            return
+
+        session['status'] = status
+        session['eval'] = eval_run
+        session['waiting'] = False
+        self.display(sid, session)
+
+    def lease(self, sid, eval_run, explore_run=False):
+        '''
+        Atomically claim the next unannotated status that is not leased by
+        another session. Exploration runs claim a status processed for
+        prefilter exploration, if there is one.
+
+        Returns the status or None if there is no work.
+        '''
+        now = time()
+        query = {'manual_relevant': None,
+                 'duplicate_of': None,
+                 'bow': {'$ne': None},
+                 'probability_relevant': {'$ne': None},
+                 # Compacted statuses lack the text to display and train on
+                 'compacted': {'$ne': True},
+                 'lease_expires': {'$not': {'$gte': now}}}
+        if not eval_run:
+            sort = [('annotation_priority', pymongo.ASCENDING)]
+        else:
+            sort = None
+        update = {'$set': {'lease_owner': sid,
+                           'lease_expires': now + self.lease_timeout}}
+
+        if explore_run:
+            status = self.database.find_one_and_update(
+                    dict(query, prefilter_explored=True), update, sort=sort,
+                    return_document=pymongo.ReturnDocument.AFTER)
+            if status is not None:
+                return status
+
+        return self.database.find_one_and_update(
+                query, update, sort=sort,
+                return_document=pymongo.ReturnDocument.AFTER)
+
+    def release(self, session):
+        '''Return the status leased by a session to the pool of work'''
+        status = session['status']
+        if status is None:
+            return
+        self.database.update({'_id': status['_id'],
+                              'lease_owner': status['lease_owner']},
+                             {'$set': {'lease_owner': None,
+                                       'lease_expires': None}})
+        session['status'] = None
+
+    def clear_leases(self):
+        '''Release all leases, e.g. those left over from a previous run'''
+        self.database.update_many({'lease_owner': {'$ne': None}},
+                                  {'$set': {'lease_owner': None,
+                                            'lease_expires': None}})
+
+    def display(self, sid, session):
+        '''Send the leased status of a session to its client'''
+        status = session['status']
+        eval_run = session['eval']
+        id_ = str(status['id'])
+        guess = str(round(status['probability_relevant'], 3))
+        logging.debug(f'Sending tweet for annotation. Id: {id_} '
+                      f'session: {sid} evaluation: {eval_run}')
+        self.socket.emit('display_tweet', {'tweet_id': id_,
+                                           'guess': guess,
+                                           'eval': str(eval_run)},
+                         room=sid, namespace=self.namespace)
+        if eval_run:
+            p = round(status['probability_relevant'], 2)
+            put_latest(self.message_queue, 'This is an evaluation Tweet '
                                            'I guess it is relevant with '
                                            f'probability {p}')
-                
-                while not self.stoprequest.isSet():
-                    try:
-                        response = self.annotation_response.get(timeout=0.1)
-                        logging.debug(f'Received response {response}')
-                        break
-                    except queue.Empty as e:
-                        continue
-                
-                if response == 'relevant':
-                    out = True
-                    self.n_positive += 1
-                elif response == 'irrelevant':
-                    out = False
-                    self.n_negative += 1
-                elif response == 'skip':
-                    out = -1
-                elif response == 'refresh':
-                    continue
-                else:
-                    logging.debug(f'Invalid response: {response}')
-                    continue
-                
-                self.first = True
-
-                # Evaluate classifier
-                if self.n_trainer_triggered > 0 and eval_run:
-                    guess = bool(round(status['probability_relevant'], 0))
-                    self.clf_performance[self.evaluate_guess(guess, out)] += 1
-
-                # Update record in DB
-                logging.debug('updating DB')
-                msg = self.database.update(
-                        {'_id': status['_id']}, 
-                        {'$set': {'manual_relevant': out,
-                                  'probability_relevant': int(out),
-                                  'annotation_priority': None,
-                                  'clf_version': float('inf')}}
-                        )
-
-                # Trigger trainer if necessary
-                logging.debug('triggering trainer')
-                threshold = (self.n_trainer_triggered+1) * self.train_threshold
-                if (self.n_positive > threshold): #and 
-                    #self.n_negative > threshold):
-                    self.train.set()
-                    self.n_trainer_triggered += 1
-
-        logging.debug('Stopped.')
 
     def evaluate_guess(self, guess, annotation):
         if guess and annotation:
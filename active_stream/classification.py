@@ -2,11 +2,18 @@ import threading
 import multiprocessing
 import logging
 import numpy as np
-import queue
 import scipy.sparse
+import tempfile
+import shutil
+import os
 
-from time import sleep
-from gensim import matutils
+from time import sleep, time
+from urllib.parse import urlparse
+from sklearn.linear_model import SGDClassifier
+from sklearn.feature_extraction.text import HashingVectorizer
+from records import Status
+from features import FeaturePruner
+from transport import put_latest
 
 
 class DummyClf(object):
@@ -20,6 +27,61 @@ class DummyClf(object):
         a = np.array([1 - self.value] * X.shape[0])
         return np.column_stack((a,b))
 
+class Prefilter(object):
+    '''
+    Cheap first stage classifier used by the `TextProcessor` to skip the full
+    NLP processing of statuses that are clearly irrelevant.
+
+    A linear model on hashed tokens of the raw status text and entities. It
+    does not depend on the dictionary and is trained by `Trainer()` on the
+    same annotations as the main model.
+
+    A random fraction `explore` of the statuses below the threshold is
+    processed anyway and marked with `prefilter_explored`. These statuses are
+    scored by the main model and offered for annotation (see
+    `annotation.Annotator`), so the prefilter is also trained on statuses it
+    rejects and does not reinforce its own errors.
+
+    Arguments:
+    ---------------
+    threshold: float, statuses with a predicted probability of relevance below
+        this value are considered irrelevant.
+    min_samples: int, minimum number of annotated statuses before the
+        prefilter is trained and used.
+    n_features: int, number of hash buckets.
+    explore: float, fraction of the statuses below the threshold that are
+        processed anyway.
+    '''
+
+    def __init__(self, threshold=0.05, min_samples=100, n_features=2**18,
+                 explore=0.01):
+        self.threshold = threshold
+        self.explore = explore
+        self.min_samples = min_samples
+        self.vectorizer = HashingVectorizer(n_features=n_features,
+                                            alternate_sign=False,
+                                            token_pattern=r'(?u)[#@]?\b\w+\b')
+        self.clf = SGDClassifier(loss='log', penalty='l2', alpha=0.0001)
+
+    def features(self, status):
+        '''Concatenate raw text and entities of a `records.Status`'''
+        parts = ([status.text, status.screen_name, status.name] +
+                 ['#' + ht[0] for ht in status.hashtags] +
+                 ['@' + user[0] for user in status.mentions] +
+                 [urlparse(url[1])[1] for url in status.urls if url[1]])
+        return ' '.join(parts)
+
+    def fit(self, statuses, y):
+        X = self.vectorizer.transform([self.features(s) for s in statuses])
+        self.clf.fit(X, y)
+        return self
+
+    def predict_proba(self, status):
+        '''Probability that a single status is relevant'''
+        X = self.vectorizer.transform([self.features(status)])
+        return self.clf.predict_proba(X)[0, 1]
+
+
 class Classifier(threading.Thread):
     '''
     Classifies statuses as relevant / irrelevant based on classification model
@@ -29,6 +91,10 @@ class Classifier(threading.Thread):
     binary classification (bool) and a field 'probability_relevant' containing
     the probability this classification is based on.
 
+    Only canonical statuses are classified, the classification is then copied
+    to their duplicates (statuses with `duplicate_of` set). Statuses discarded
+    by the `Prefilter` (`bow` is None) keep the prefilter classification.
+
     Arguments:
     --------------- 
     database: MongoDB connection
@@ -36,10 +102,13 @@ class Classifier(threading.Thread):
     threshold: Threshold in predicted probability to classify to relevant /
         irrelevant.
     batchsize: How many statues to classifiy in one batch
+    shard: tuple (index, n_shards) or None. If given only statuses with
+        `id % n_shards == index` are classified, so several classifier
+        processes can share a collection (see distributed.py)
     '''
 
-    def __init__(self, data, threshold=0.5, batchsize=1000):
-        super(Classifier, self).__init__(name="Classifier")
+    def __init__(self, data, threshold=0.5, batchsize=1000, shard=None):
+        super(Classifier, self).__init__(name=f'Classifier/{data["topic"]}')
         self.clf = DummyClf(threshold)
         self.database = data['database']
         self.threshold = threshold
@@ -48,6 +117,11 @@ class Classifier(threading.Thread):
         self.model_queue = data['queues']['model']
         self.dictionary = data['dictionary']
         self.clf_version = 0
+        if shard is not None:
+            index, n_shards = shard
+            self.shard_query = {'id': {'$mod': [n_shards, index]}}
+        else:
+            self.shard_query = {}
 
     def run(self):
         logging.debug('Ready!')
@@ -57,12 +131,21 @@ class Classifier(threading.Thread):
             if not self.model_queue.empty():
                 logging.info(f'Received new model (version {self.clf_version})')
                 self.clf = self.model_queue.get()
-                self.clf_version += 1
-                to_classify = self.database.find({'manual_relevant': None})
+                # Models are tagged with their version by the Trainer. A model
+                # that was replaced before it was picked up is skipped
+                self.clf_version = getattr(self.clf, 'version_',
+                                           self.clf_version + 1)
+                to_classify = self.database.find({'manual_relevant': None,
+                                                  'duplicate_of': None,
+                                                  'bow': {'$ne': None},
+                                                  **self.shard_query})
 
             else:
                 to_classify = self.database.find({'probability_relevant': None,
-                                                  'manual_relevant': None})
+                                                  'manual_relevant': None,
+                                                  'duplicate_of': None,
+                                                  'bow': {'$ne': None},
+                                                  **self.shard_query})
         
             count_new = to_classify.count()
             if count_new > 0:
@@ -92,29 +175,19 @@ class Classifier(threading.Thread):
          
         corpus = [status['bow'] for status in batch] 
 
-        corpus = [0] * len(batch)
-        dict_sizes = np.zeros(len(batch), dtype=int)
-        for i,s in enumerate(batch):
-            corpus[i] = s['bow']
-            dict_sizes[i] = s['dict_size']
-
-        n_terms_dict = max(dict_sizes)
-
-        try:
-            n_terms_model = self.clf.coef_.shape[1]
-        except IndexError:
-            logging.debug('Weird coef shape dimensions')
-            n_terms_model = len(self.clf.coef_)
-        #logging.debug(f'n_coefs: {n_terms_model}')
-
-        if n_terms_model > n_terms_dict:
-            n_terms_dict = n_terms_model
-        
-        X = matutils.corpus2dense(corpus, num_docs=len(corpus),
-                                  num_terms=n_terms_dict).transpose()
-        
-        if n_terms_dict > n_terms_model:
-            X = X[:, :n_terms_model]
+        # Models trained by the Trainer carry the feature space they were
+        # trained on
+        feature_map = getattr(self.clf, 'feature_map_', None)
+        if feature_map is not None:
+            X = feature_map.transform(corpus)
+        else:
+            try:
+                n_terms_model = self.clf.coef_.shape[1]
+            except IndexError:
+                logging.debug('Weird coef shape dimensions')
+                n_terms_model = len(self.clf.coef_)
+            # Terms the model has not seen during training are dropped
+            X = corpus2csr(corpus, num_terms=n_terms_model)
 
         #logging.debug(f'X.shape: {X.shape}') 
         probs = self.clf.predict_proba(X)[:, 1]
@@ -127,11 +200,15 @@ class Classifier(threading.Thread):
             else:
                 clf_rel = True
 
-            bulk.find({'_id': status['_id']}).update(
-                      {"$set":{'probability_relevant': prob,
-                               'classifier_relevant': clf_rel,
-                               'annotation_priority': ap,
-                               'clf_version': self.clf_version}})
+            update = {"$set":{'probability_relevant': prob,
+                              'classifier_relevant': clf_rel,
+                              'annotation_priority': ap,
+                              'clf_version': self.clf_version,
+                              'classified_at': time()}}
+            bulk.find({'_id': status['_id']}).update(update)
+            if status.get('n_duplicates', 0) > 0:
+                bulk.find({'duplicate_of': status['id'],
+                           'manual_relevant': None}).update(update)
 
         msg = bulk.execute() 
 
@@ -141,32 +218,110 @@ class Classifier(threading.Thread):
         super(Classifier, self).join(timeout)
 
 
+def corpus2csr(corpus, num_terms, dtype=np.float64):
+    '''
+    Convert a gensim corpus (list of bag of words) to a sparse document-term
+    matrix. Term ids >= num_terms are dropped.
+    '''
+    lengths = np.array([len(doc) for doc in corpus], dtype=np.int64)
+    indptr = np.zeros(len(corpus) + 1, dtype=np.int32)
+    if len(corpus) == 0 or lengths.sum() == 0:
+        return scipy.sparse.csr_matrix((len(corpus), num_terms), dtype=dtype)
+    pairs = np.array([pair for doc in corpus for pair in doc])
+    indices = pairs[:, 0].astype(np.int32)
+    values = pairs[:, 1].astype(dtype)
+    keep = indices < num_terms
+    rows = np.repeat(np.arange(len(corpus)), lengths)[keep]
+    indptr[1:] = np.cumsum(np.bincount(rows, minlength=len(corpus)))
+    return scipy.sparse.csr_matrix((values[keep], indices[keep], indptr),
+                                   shape=(len(corpus), num_terms))
+
+
+def save_matrix(X, directory):
+    '''Store a csr matrix as .npy files that can be memory mapped'''
+    np.save(os.path.join(directory, 'data.npy'), X.data)
+    np.save(os.path.join(directory, 'indices.npy'), X.indices)
+    np.save(os.path.join(directory, 'indptr.npy'), X.indptr)
+
+
+def load_matrix(directory, shape):
+    '''Memory map a csr matrix stored with `save_matrix()`'''
+    arrays = [np.load(os.path.join(directory, name + '.npy'), mmap_mode='r')
+              for name in ['data', 'indices', 'indptr']]
+    return scipy.sparse.csr_matrix(tuple(arrays), shape=shape, copy=False)
+
+
+def fit_model(clf, matrix_dir, shape, y, prefilter=None, statuses=None,
+              statuses_y=None):
+    '''
+    Fit `clf` (and optionally the prefilter on `statuses` with labels
+    `statuses_y`) in the training process. The feature matrix is memory
+    mapped from `matrix_dir`. Returns the fitted models.
+    '''
+    X = load_matrix(matrix_dir, shape)
+    clf.fit(X, y)
+    if prefilter is not None:
+        prefilter.fit(statuses, statuses_y)
+    return clf, prefilter
+
+
 class Trainer(threading.Thread):
     '''
     (Re)Trains classification model.
 
+    Models are trained on a compacted feature space without rare and
+    ubiquitous tokens (see `features.FeaturePruner`). The `FeatureMap` is
+    attached to the model as `feature_map_` so the Classifier can map the
+    stored bag of words representations to it.
+
+    The training data is assembled in this thread and written to memory
+    mapped files. The model is fitted in a separate process, so fitting does
+    not compete with the other threads for the GIL. Every training run
+    produces a new model object that is placed into `queues['model']`.
 
     Arguments:
     --------------- 
     data: dictionary of data shared data structurs. See app.py for details
     clf: A classifier object. Must contain a `fit(X, y)` method (see sk learn
-        models)
+        models). Used as template, it is never fitted itself.
     streamer: threading.Thread
+    prefilter: Prefilter or None. If given a prefilter is trained alongside
+        the main model and placed into `queues['prefilter_model']`
+    tmp_dir: str, directory for the memory mapped feature matrices. Defaults
+        to the system temp directory.
+    pruner: features.FeaturePruner. Rare and ubiquitous tokens are dropped
+        from the feature space. Defaults to a pruner with default settings.
     
     '''
 
-    def __init__(self, clf, streamer, data):
-        super(Trainer, self).__init__(name='Trainer')
+    # Fields required from annotated statuses for training
+    projection = ['id', 'bow', 'dict_size', 'text', 'user.screen_name',
+                  'user.name', 'entities', 'compacted']
+
+    def __init__(self, clf, streamer, data, prefilter=None, tmp_dir=None,
+                 pruner=None):
+        super(Trainer, self).__init__(name=f'Trainer/{data["topic"]}')
         self.clf = clf
         self.model_queue = data['queues']['model']
         self.trigger = data['events']['train_model'] 
         self.stoprequest = threading.Event()
         self.database = data['database']
         self.dictionary = data['dictionary']
+        self.dictionary_lock = data['locks']['dictionary']
         self.mif_queue = data['queues']['most_important_features']
         self.clf_version = 0
         self.message_queue = data['queues']['messages']
         self.streamer = streamer
+        self.prefilter = prefilter
+        self.prefilter_queue = data['queues']['prefilter_model']
+        self.tmp_dir = tmp_dir
+        if pruner is None:
+            pruner = FeaturePruner(data)
+        self.pruner = pruner
+        self.pool = None
+        self.admission = data['admission']
+        self.topic = data['topic']
+        self.n_priority_tokens = 100
         self.mif_stopwords = set([' ', '-PRON-', '.', '-', ':', ';',
                                   '&', 'amp', 'RT'])
 
@@ -176,70 +331,117 @@ class Trainer(threading.Thread):
         '''
         # Transform data y = []
         corpus = []
-        dict_lens = []
         y = []
+        # Statuses with their raw fields, for the prefilter
+        statuses = []
+        statuses_y = []
         # Get all manually annotated docs from db
         #cursor = self.database.find({'manual_relevant': {'$ne': None}}) 
 
         # First get all relevant tweets
-        cursor = self.database.find({'manual_relevant': True}) 
+        cursor = self.database.find({'manual_relevant': True,
+                                     'duplicate_of': None,
+                                     'bow': {'$ne': None}},
+                                    projection=self.projection)
         for d in cursor:
-            # Ignore skipped statuses
-            if d['manual_relevant'] == -1:
-                continue
             corpus.append(d['bow'])
-            dict_lens.append(d['dict_size'])
             y.append(True)
+            # Compacted statuses only keep the bag of words
+            if not d.get('compacted'):
+                statuses.append(Status.from_dict(d))
+                statuses_y.append(True)
         
         samp_size = len(y)
-        cursor = (self.database.find({'manual_relevant': False})
+        # Compacted statuses lack the raw text required by the prefilter
+        cursor = (self.database.find({'manual_relevant': False,
+                                      'duplicate_of': None,
+                                      'bow': {'$ne': None},
+                                      'compacted': {'$ne': True}},
+                                     projection=self.projection)
                                .limit(samp_size)) #TODO: This should be random sample
         for d in cursor:
             corpus.append(d['bow'])
-            dict_lens.append(d['dict_size'])
             y.append(False)
+            statuses.append(Status.from_dict(d))
+            statuses_y.append(False)
 
-        X = matutils.corpus2dense(corpus, num_docs=len(corpus),
-                                  num_terms=max(dict_lens)).transpose()
+        feature_map = self.pruner.update()
+        X = feature_map.transform(corpus)
         y = np.array(y)
+
+        if (self.prefilter is not None and
+                len(statuses_y) >= self.prefilter.min_samples and
+                len(set(statuses_y)) == 2):
+            prefilter = self.prefilter
+        else:
+            prefilter = None
+            statuses = None
+            statuses_y = None
         
-        # Fit model
-        #self.clf.partial_fit(X, y, classes=np.array([0, 1]))
-        self.clf.fit(X, y)
-        mif_indices = sorted(enumerate(self.clf.coef_[0]), key=lambda x: x[1], 
+        # Fit model in the training process
+        matrix_dir = tempfile.mkdtemp(prefix='active_stream_', dir=self.tmp_dir)
+        try:
+            save_matrix(X, matrix_dir)
+            shape = X.shape
+            del X
+            result = self.pool.apply_async(fit_model,
+                                           (self.clf, matrix_dir, shape, y,
+                                            prefilter, statuses, statuses_y))
+            clf, prefilter = result.get()
+        finally:
+            shutil.rmtree(matrix_dir, ignore_errors=True)
+        clf.feature_map_ = feature_map
+
+        mif_indices = sorted(enumerate(clf.coef_[0]), key=lambda x: x[1], 
                              reverse=True)
-        mif_indices = [x[0] for x in mif_indices]
-        mif = []
+        mif_indices = [x[0] for x in mif_indices if x[1] > 0]
         # Update list of tracked keywords
         self.mif_stopwords.update([x.lower() for x in self.streamer.keywords])
-        for id_ in mif_indices:
-            word = self.dictionary.id2token[id_]
+        # Only look up as many tokens as can be needed, each lookup is a round
+        # trip with a shared dictionary
+        n_lookup = self.n_priority_tokens + len(self.mif_stopwords)
+        with self.dictionary_lock:
+            words = [self.dictionary[feature_map.ids[idx]]
+                     for idx in mif_indices[:n_lookup]]
+        mif = []
+        for word in words:
             if word not in self.mif_stopwords:
                 mif.append(word)
             else:
                 continue
-            if len(mif) == 10:
+            if len(mif) == self.n_priority_tokens:
                 break
-        self.mif_queue.put(mif)
+        put_latest(self.mif_queue, mif[:10])
+        # High weight tokens are favored by the admission controller
+        self.admission.set_priority_tokens(mif, self.topic)
 
         # Pass model to classifier
         self.clf_version += 1
-        self.model_queue.put(self.clf)
+        clf.version_ = self.clf_version
+        # Replace a model or prefilter that has not been picked up yet
+        put_latest(self.model_queue, clf)
+
+        if prefilter is not None:
+            put_latest(self.prefilter_queue, prefilter)
 
         
     def run(self):
         logging.debug('Ready!')
+        # Fresh interpreter for the training process. Forking a process that
+        # runs threads and holds database connections is not safe.
+        self.pool = multiprocessing.get_context('spawn').Pool(1)
         # Wait for first positive / negative annotation
         while not self.stoprequest.isSet():
         
-            if self.trigger.isSet():
+            if self.trigger.is_set():
                 logging.info(f'Training new model (version {self.clf_version})')
-                self.message_queue.put("Training new model")
+                put_latest(self.message_queue, "Training new model")
                 self.train_model()
                 self.trigger.clear()
             else:
                 sleep(0.05)
 
+        self.pool.terminate()
         logging.debug('Stopped')
 
 
@@ -0,0 +1,141 @@
+import re
+import zlib
+import hashlib
+
+import numpy as np
+
+from collections import OrderedDict
+
+
+class Deduplicator(object):
+    '''
+    Finds retweets, copies and near-duplicates of statuses seen before.
+
+    Each cluster of duplicates is represented by its first status (the
+    canonical status). A status is matched to a cluster if
+    - it is a retweet of the canonical status or of the same original status,
+    - its normalized text is identical to the one of the canonical status, or
+    - the Jaccard similarity of the word shingles of the two texts, estimated
+      with MinHash and looked up with LSH, is at least `threshold`.
+
+    The index only holds the `capacity` most recently matched clusters.
+
+    Arguments:
+    ---------------
+    num_perm: int, number of MinHash permutations
+    bands: int, number of LSH bands. Must divide `num_perm`
+    threshold: float, minimum estimated Jaccard similarity for near-duplicates
+    shingle_size: int, number of words per shingle
+    min_tokens: int, statuses with fewer normalized tokens are only matched
+        as retweets
+    capacity: int, maximum number of clusters kept in the index
+    '''
+
+    _prime = (1 << 31) - 1
+    _url_pattern = re.compile(r'https?://\S+')
+    _rt_pattern = re.compile(r'^rt @\w+:')
+    _token_pattern = re.compile(r'[#@]?\w+')
+
+    def __init__(self, num_perm=64, bands=16, threshold=0.8, shingle_size=3,
+                 min_tokens=4, capacity=100000, seed=0):
+        if num_perm % bands != 0:
+            raise ValueError('`bands` must divide `num_perm`')
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.min_tokens = min_tokens
+        self.capacity = capacity
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, self._prime, size=num_perm).astype(np.uint64)
+        self.b = rng.randint(0, self._prime, size=num_perm).astype(np.uint64)
+        # canonical id -> {'id', 'bow', 'dict_size', 'minhash', 'keys'}
+        self.clusters = OrderedDict()
+        # key -> canonical id
+        self.index = {}
+
+    def normalize(self, text):
+        '''Lowercase, strip retweet prefix and urls and tokenize text'''
+        text = self._rt_pattern.sub('', text.lower())
+        text = self._url_pattern.sub(' ', text)
+        return self._token_pattern.findall(text)
+
+    def minhash(self, tokens):
+        '''MinHash signature of the word shingles of a token list'''
+        k = min(self.shingle_size, len(tokens))
+        shingles = set(' '.join(tokens[i:i+k])
+                       for i in range(len(tokens) - k + 1))
+        x = np.array([zlib.crc32(s.encode('utf-8')) for s in shingles],
+                     dtype=np.uint64)
+        hashes = (np.outer(x, self.a) + self.b) % self._prime
+        return hashes.min(axis=0)
+
+    def signature(self, status):
+        '''
+        Compute the lookup keys and the MinHash signature of a status.
+
+        Returns a tuple (keys, minhash). minhash is None if the status is too
+        short to be matched by content.
+        '''
+        keys = [('id', status.id)]
+        if status.retweeted_id is not None:
+            keys.append(('id', status.retweeted_id))
+
+        tokens = self.normalize(status.text)
+        if len(tokens) < self.min_tokens:
+            return keys, None
+
+        digest = hashlib.md5(' '.join(tokens).encode('utf-8')).digest()
+        keys.append(('text', digest))
+        minhash = self.minhash(tokens)
+        for i in range(self.bands):
+            band = minhash[i*self.rows:(i+1)*self.rows]
+            keys.append(('band', i, band.tobytes()))
+        return keys, minhash
+
+    def match(self, signature):
+        '''
+        Find the cluster a status belongs to.
+
+        signature: tuple, as returned by `signature()`
+
+        Returns the cluster dict or None if the status is not a duplicate.
+        '''
+        keys, minhash = signature
+        for key in keys:
+            canonical_id = self.index.get(key)
+            if canonical_id is None:
+                continue
+            cluster = self.clusters[canonical_id]
+            if key[0] == 'band':
+                # LSH candidate, check the estimated similarity
+                similarity = np.mean(cluster['minhash'] == minhash)
+                if similarity < self.threshold:
+                    continue
+            self.clusters.move_to_end(canonical_id)
+            return cluster
+        return None
+
+    def add(self, signature, status):
+        '''
+        Register a processed status as canonical status of a new cluster.
+
+        signature: tuple, as returned by `signature()`
+        status: records.Status, the processed status
+        '''
+        keys, minhash = signature
+        cluster = {'id': status.id,
+                   'bow': status['bow'],
+                   'dict_size': status['dict_size'],
+                   'minhash': minhash,
+                   'keys': keys}
+        self.clusters[status.id] = cluster
+        for key in keys:
+            self.index.setdefault(key, status.id)
+
+        while len(self.clusters) > self.capacity:
+            _, evicted = self.clusters.popitem(last=False)
+            for key in evicted['keys']:
+                if self.index.get(key) == evicted['id']:
+                    del self.index[key]
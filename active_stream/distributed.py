@@ -0,0 +1,457 @@
+'''
+Distributed mode: the stages of the pipeline run as separate processes,
+optionally on separate hosts, and communicate through a broker (see
+transport.py).
+
+- broker: holds the queues, the shared state and the dictionary. All token
+  ids are assigned by the broker, so the text processor workers agree on them
+- streamer: the Streamer and the admission controller. Statuses are
+  distributed over the text processor workers by the id of the status they
+  retweet (or their own id), so retweets of a status meet in the same
+  worker and its duplicate detection
+- text_processor: one process per worker
+- classifier: one process per shard. A shard classifies the statuses with
+  `id % shards == shard`. New models are broadcast to all shards
+- trainer: trains the models of all topics and broadcasts them to the
+  classifier shards and the prefilters to the text processor workers
+- web: `python app.py --distributed <broker address>` runs the web interface,
+  the Annotators, Monitors and Retention
+
+Counters the processes need from each other (missed, shed and overflow counts,
+keywords, model versions, priority tokens, text processing latency) are
+exchanged through the shared state of the broker by `StateSync` threads.
+
+Usage:
+    python active_stream/distributed.py broker
+    python active_stream/distributed.py streamer --workers 2
+    python active_stream/distributed.py text_processor --worker 0 --workers 2
+    python active_stream/distributed.py text_processor --worker 1 --workers 2
+    python active_stream/distributed.py classifier --shard 0 --shards 2
+    python active_stream/distributed.py classifier --shard 1 --shards 2
+    python active_stream/distributed.py trainer --workers 2 --shards 2
+    python app.py --distributed localhost:5001
+'''
+import argparse
+import threading
+import logging
+import queue
+import sys
+import os
+
+import numpy as np
+
+from time import sleep
+from pymongo import MongoClient
+from sklearn.linear_model import SGDClassifier
+
+from transport import SocketTransport, SharedDictionary, ShardedQueue, \
+                      BroadcastQueue, serve
+from topics import Topic
+
+
+def parse_address(address):
+    '''"host:port" -> (host, port)'''
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+def parse_topics(spec):
+    '''"name=collection,..." -> {name: collection}'''
+    topics = {}
+    for item in spec.split(','):
+        name, collection = item.split('=')
+        topics[name] = collection
+    return topics
+
+
+def get_authkey(value=None):
+    '''
+    The shared secret of the broker as bytes, from `value` or the environment
+    variable ACTIVE_STREAM_AUTHKEY. The broker unpickles what clients send, so
+    there is no default: anyone who knows the secret and can reach the broker
+    can run code on it.
+
+    Raises ValueError if no secret is set.
+    '''
+    if value is None:
+        value = os.environ.get('ACTIVE_STREAM_AUTHKEY')
+    if not value:
+        raise ValueError('No broker secret. Set ACTIVE_STREAM_AUTHKEY or '
+                         'pass --authkey')
+    return value.encode('utf-8')
+
+
+def shard_key(status):
+    '''Statuses with the same key are processed by the same worker'''
+    if status.retweeted_id is not None:
+        return status.retweeted_id
+    return status.id
+
+
+def shard_queues(transport, name, n):
+    '''The queues `<name>/0` ... `<name>/<n-1>` of size 1'''
+    return [transport.queue(f'{name}/{i}', 1) for i in range(n)]
+
+
+class SharedAdmission(object):
+    '''
+    Stand-in for the `admission.AdmissionController` in processes other than
+    the streamer. Priority tokens, shed and overflow counts are exchanged
+    through the shared state, the processing latency is published by
+    `StateSync`.
+
+    Arguments:
+    ---------------
+    state: dict, the shared state
+    smoothing: float, weight of new observations in the latency average
+    '''
+
+    def __init__(self, state, smoothing=0.05):
+        self.state = state
+        self.smoothing = smoothing
+        self.latency = None
+
+    def set_priority_tokens(self, tokens, topic=None):
+        self.state[f'{topic}/priority_tokens'] = list(tokens)
+
+    def observe_latency(self, seconds):
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency += self.smoothing * (seconds - self.latency)
+
+    @property
+    def shed(self):
+        return self.state.get('shed', {'track': 0, 'sample': 0})
+
+    @property
+    def overflow(self):
+        return self.state.get('overflow', {'track': 0, 'sample': 0})
+
+
+class StreamerState(object):
+    '''
+    Stand-in for the `streaming.Streamer` in processes other than the
+    streamer: its counters and keywords as published to the shared state.
+
+    Arguments:
+    ---------------
+    state: dict, the shared state
+    topics: dict, name -> topics.Topic
+    '''
+
+    def __init__(self, state, topics):
+        self.state = state
+        self.topics = topics
+
+    @property
+    def missed(self):
+        return self.state.get('missed', 0)
+
+    @property
+    def keywords(self):
+        keywords = set()
+        for name in self.topics:
+            keywords.update(self.state.get(f'{name}/keywords', []))
+        return keywords
+
+
+class ClassifierState(object):
+    '''
+    Stand-in for the `classification.Classifier` of a topic in processes
+    other than the classifier shards. `clf_version` is the version all shards
+    have reached.
+
+    Arguments:
+    ---------------
+    state: dict, the shared state
+    topic: str, name of the topic
+    '''
+
+    def __init__(self, state, topic):
+        self.state = state
+        self.prefix = f'{topic}/clf_version/'
+
+    @property
+    def clf_version(self):
+        versions = [v for k, v in self.state.items()
+                    if k.startswith(self.prefix)]
+        if len(versions) == 0:
+            return 0
+        return min(versions)
+
+
+class StateSync(threading.Thread):
+    '''
+    Periodically calls `sync`, which exchanges values with the other
+    processes through the shared state.
+
+    Arguments:
+    ---------------
+    sync: callable without arguments
+    interval: float, seconds between calls
+    '''
+
+    def __init__(self, sync, interval=1):
+        super(StateSync, self).__init__(name='State Sync')
+        self.sync = sync
+        self.interval = interval
+        self.stoprequest = threading.Event()
+
+    def run(self):
+        logging.debug('Ready!')
+        while not self.stoprequest.wait(self.interval):
+            try:
+                self.sync()
+            except Exception as e:
+                logging.error(f'Error synchronizing state: {e}')
+        logging.debug('Stopped')
+
+    def join(self, timeout=None):
+        self.stoprequest.set()
+        super(StateSync, self).join(timeout)
+
+
+def keyword_sync(state, topics):
+    '''Sync function that copies the keywords of the streamer to `topics`'''
+    def sync():
+        for name, topic in topics.items():
+            keywords = state.get(f'{name}/keywords')
+            if keywords is not None:
+                # Replaced, not updated in place: other threads may be
+                # iterating over the current set
+                topic.keywords = set(keywords)
+    return sync
+
+
+def build_data(transport, db, topic_collections, buf_size,
+               text_processing=None, filters=None, socket=None,
+               mongo_host='localhost'):
+    '''
+    Data structures of a process in distributed mode. Same layout as in
+    app.py, the queues, events and the dictionary are provided by the
+    transport.
+
+    text_processing: the text processing queue of the process, if it uses one
+    '''
+    data = {
+            'queues': {
+                'text_processing': text_processing,
+                'keywords': transport.queue('keywords', buf_size),
+                'limit': queue.Queue(buf_size)
+                },
+            'dictionary': SharedDictionary(transport.dictionary()),
+            'locks': {
+                'dictionary': threading.Lock()
+                },
+            'filters': filters,
+            'socket': socket,
+            'admission': SharedAdmission(transport.state())
+            }
+    data['topics'] = {}
+    client = MongoClient(mongo_host)
+    for name, collection in topic_collections.items():
+        data['topics'][name] = Topic(name, data, client[db][collection],
+                                     buf_size, transport)
+    return data
+
+
+def run_threads(threads):
+    '''Start threads and wait until one of them stops or Ctrl-C'''
+    for t in threads:
+        t.start()
+    try:
+        while all(t.is_alive() for t in threads):
+            sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for t in threads:
+            t.join()
+
+
+def run_broker(args):
+    # Start a new collection
+    client = MongoClient(args.mongo)
+    for collection in parse_topics(args.topics).values():
+        database = client[args.db][collection]
+        database.drop()
+        database.create_index('id')
+        database.create_index('duplicate_of')
+        database.create_index([('classified_at', 1), ('_id', 1)])
+    logging.info(f'Broker listening on {args.broker}')
+    serve(parse_address(args.broker), args.authkey)
+
+
+def run_streamer(args, transport):
+    from streaming import Streamer
+    from admission import AdmissionController
+    # credentials.py is located next to app.py, see README
+    sys.path.append(os.getcwd())
+    from credentials import credentials
+
+    text_processing = ShardedQueue(
+            [transport.queue(f'text_processing/{i}', args.buf_size)
+             for i in range(args.workers)],
+            key=shard_key)
+    data = build_data(transport, args.db, parse_topics(args.topics),
+                      args.buf_size, text_processing=text_processing,
+                      filters={'languages': args.languages},
+                      mongo_host=args.mongo)
+    admission = AdmissionController(policy=args.shedding_policy)
+    data['admission'] = admission
+    streamer = Streamer(credentials_track=credentials['coll_1'],
+                        credentials_sample=credentials['main_account'],
+                        data=data)
+    state = transport.state()
+
+    def sync():
+        state['missed'] = streamer.missed
+        state['shed'] = dict(admission.shed)
+        state['overflow'] = dict(admission.overflow)
+        for name, topic in data['topics'].items():
+            state[f'{name}/keywords'] = sorted(topic.keywords)
+            tokens = state.get(f'{name}/priority_tokens')
+            if tokens is not None:
+                admission.set_priority_tokens(tokens, name)
+        # The workers process statuses in parallel, the pipeline keeps up as
+        # long as statuses arrive slower than every latency / workers seconds
+        latencies = [state.get(f'latency/{i}') for i in range(args.workers)]
+        latencies = [l for l in latencies if l is not None]
+        if len(latencies) > 0:
+            admission.latency = np.mean(latencies) / args.workers
+
+    run_threads([streamer, StateSync(sync)])
+
+
+def run_text_processor(args, transport):
+    from text_processing import TextProcessor
+    from dedup import Deduplicator
+
+    worker = args.worker
+    data = build_data(transport, args.db, parse_topics(args.topics),
+                      args.buf_size,
+                      text_processing=transport.queue(
+                          f'text_processing/{worker}', args.buf_size),
+                      mongo_host=args.mongo)
+    for topic in data['topics'].values():
+        topic.data['queues']['prefilter_model'] = transport.queue(
+                f'{topic.name}/prefilter_model/{worker}', 1)
+    text_processor = TextProcessor(
+            data, deduplicator=Deduplicator(capacity=args.dedup_capacity))
+    state = transport.state()
+    admission = data['admission']
+    # Statuses are routed to topics by their keywords
+    sync_keywords = keyword_sync(state, data['topics'])
+
+    def sync():
+        sync_keywords()
+        if admission.latency is not None:
+            state[f'latency/{worker}'] = admission.latency
+
+    sync_keywords()
+    run_threads([text_processor, StateSync(sync)])
+
+
+def run_classifier(args, transport):
+    from classification import Classifier
+
+    data = build_data(transport, args.db, parse_topics(args.topics),
+                      args.buf_size, mongo_host=args.mongo)
+    classifiers = {}
+    for topic in data['topics'].values():
+        topic.data['queues']['model'] = transport.queue(
+                f'{topic.name}/model/{args.shard}', 1)
+        classifiers[topic.name] = Classifier(topic.data,
+                                             shard=(args.shard, args.shards))
+    state = transport.state()
+
+    def sync():
+        for name, classifier in classifiers.items():
+            state[f'{name}/clf_version/{args.shard}'] = classifier.clf_version
+
+    run_threads(list(classifiers.values()) + [StateSync(sync)])
+
+
+def run_trainer(args, transport):
+    from classification import Trainer, Prefilter
+    from features import FeaturePruner
+
+    data = build_data(transport, args.db, parse_topics(args.topics),
+                      args.buf_size, mongo_host=args.mongo)
+    streamer = StreamerState(transport.state(), data['topics'])
+    trainers = []
+    for topic in data['topics'].values():
+        topic.data['queues']['model'] = BroadcastQueue(
+                shard_queues(transport, f'{topic.name}/model', args.shards))
+        topic.data['queues']['prefilter_model'] = BroadcastQueue(
+                shard_queues(transport, f'{topic.name}/prefilter_model',
+                             args.workers))
+        if args.prefilter_threshold is not None:
+            prefilter = Prefilter(threshold=args.prefilter_threshold,
+                                  explore=args.prefilter_explore)
+        else:
+            prefilter = None
+        trainers.append(Trainer(data=topic.data, streamer=streamer,
+                                clf=SGDClassifier(loss='log', penalty='l1',
+                                                  alpha=0.001),
+                                prefilter=prefilter,
+                                pruner=FeaturePruner(
+                                    topic.data, no_below=args.prune_no_below,
+                                    no_above=args.prune_no_above)))
+
+    run_threads(trainers)
+
+
+roles = {
+        'streamer': run_streamer,
+        'text_processor': run_text_processor,
+        'classifier': run_classifier,
+        'trainer': run_trainer
+        }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+            description='Run a stage of the pipeline in distributed mode')
+    parser.add_argument('role', choices=['broker'] + list(roles))
+    parser.add_argument('--broker', default='localhost:5001',
+                        help='Address of the broker, host:port')
+    parser.add_argument('--authkey', default=None,
+                        help='Shared secret of the broker. Defaults to the '
+                             'environment variable ACTIVE_STREAM_AUTHKEY')
+    parser.add_argument('--mongo', default='localhost')
+    parser.add_argument('--db', default='active_stream')
+    parser.add_argument('--topics', default='default=dump',
+                        help='Topics and their collections: '
+                             'name=collection,...')
+    parser.add_argument('--buf-size', type=int, default=1000)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of text processor workers')
+    parser.add_argument('--worker', type=int, default=0,
+                        help='Index of this text processor worker')
+    parser.add_argument('--shards', type=int, default=1,
+                        help='Number of classifier shards')
+    parser.add_argument('--shard', type=int, default=0,
+                        help='Index of this classifier shard')
+    parser.add_argument('--languages', nargs='+', default=['en'])
+    parser.add_argument('--shedding-policy', default='uniform')
+    parser.add_argument('--dedup-capacity', type=int, default=100000)
+    parser.add_argument('--prefilter-threshold', type=float, default=0.05)
+    parser.add_argument('--prefilter-explore', type=float, default=0.01)
+    parser.add_argument('--prune-no-below', type=int, default=2)
+    parser.add_argument('--prune-no-above', type=float, default=0.5)
+    args = parser.parse_args()
+    try:
+        args.authkey = get_authkey(args.authkey)
+    except ValueError as e:
+        parser.error(str(e))
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s (%(threadName)s) %(message)s')
+
+    if args.role == 'broker':
+        run_broker(args)
+    else:
+        transport = SocketTransport(parse_address(args.broker), args.authkey)
+        roles[args.role](args, transport)
@@ -0,0 +1,212 @@
+'''
+Bulk export of classified statuses to chunked, compressed NDJSON or Parquet
+files.
+
+Statuses are read in the order of their last classification (`classified_at`,
+then `_id`) with a server side cursor, so memory use only depends on the chunk
+size. The position of the last exported status is stored in the output
+directory together with the query, and the next export of the same query into
+the same directory continues from there. Statuses that are re-classified after
+they were exported and still match the query are exported again, the record
+with the latest `classified_at` supersedes earlier ones.
+
+Statuses classified within the last `settle` seconds are left for the next
+export, so classifications that are still being written are not skipped. In
+distributed mode the clocks of all hosts have to agree to within `settle`.
+
+Usage:
+    python active_stream/export.py exports/v3 --clf-version 3 --relevant
+'''
+import argparse
+import logging
+import json
+import gzip
+import time
+import os
+
+from bson import ObjectId
+from pymongo import MongoClient
+
+from snapshot import atomic_write
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+fields = ['id', 'text', 'probability_relevant', 'classifier_relevant',
+          'manual_relevant', 'clf_version', 'classified_at', 'sample']
+order = [('classified_at', 1), ('_id', 1)]
+state_file = 'export_state.json'
+
+
+def build_query(clf_version=None, relevant=None, sample=None):
+    '''
+    MongoDB query for an export.
+
+    clf_version: int, only statuses classified by this model version
+    relevant: bool, only statuses classified as relevant (True) / irrelevant
+    sample: str, 'track' or 'sample'
+    '''
+    query = {}
+    if clf_version is not None:
+        query['clf_version'] = clf_version
+    if relevant is not None:
+        query['classifier_relevant'] = relevant
+    if sample is not None:
+        query['sample'] = sample
+    return query
+
+
+def incremental_query(query, after=None, until=None):
+    '''
+    Restrict `query` to statuses classified after a previous export.
+
+    after: tuple (classified_at, _id) of the last status of the previous export
+    until: float, only statuses classified before this time
+    '''
+    conditions = [query]
+    if after is not None:
+        classified_at, last_id = after
+        conditions.append({'$or': [
+            {'classified_at': {'$gt': classified_at}},
+            {'classified_at': classified_at, '_id': {'$gt': ObjectId(last_id)}}
+            ]})
+    if until is not None:
+        conditions.append({'classified_at': {'$lt': until}})
+    return {'$and': conditions}
+
+
+def to_row(status):
+    '''Flat export record of a status'''
+    row = {field: status.get(field) for field in fields}
+    row['_id'] = str(status['_id'])
+    # Skipped annotations and the version of annotated statuses carry no
+    # classification information
+    if row['manual_relevant'] == -1:
+        row['manual_relevant'] = None
+    if row['clf_version'] == float('inf'):
+        row['clf_version'] = None
+    return row
+
+
+def iter_rows(database, query, batch_size=1000):
+    '''Stream the export records of all statuses matching `query`'''
+    cursor = (database.find(query, projection=fields, no_cursor_timeout=True)
+                      .sort(order)
+                      .batch_size(batch_size))
+    try:
+        for status in cursor:
+            yield to_row(status)
+    finally:
+        cursor.close()
+
+
+def write_ndjson(outfile, rows):
+    with gzip.GzipFile(fileobj=outfile, mode='wb') as out:
+        for row in rows:
+            out.write(json.dumps(row).encode('utf-8'))
+            out.write(b'\n')
+
+
+def write_parquet(outfile, rows):
+    columns = {name: [row[name] for row in rows] for name in ['_id'] + fields}
+    table = pyarrow.Table.from_pydict(columns)
+    pyarrow.parquet.write_table(table, outfile, compression='snappy')
+
+
+writers = {'ndjson': (write_ndjson, 'ndjson.gz'),
+           'parquet': (write_parquet, 'parquet')}
+
+
+def export(database, out_dir, query, fmt='ndjson', chunk_size=100000,
+           batch_size=1000, settle=60):
+    '''
+    Export all statuses matching `query` to chunk files in `out_dir`. Continues
+    after the last status exported into `out_dir` by a previous run. Raises
+    ValueError if `out_dir` holds an export of a different query.
+
+    settle: float, seconds. Statuses classified more recently are not exported
+
+    Returns the number of exported statuses.
+    '''
+    if fmt not in writers:
+        raise ValueError(f'Unknown export format: {fmt}')
+    if fmt == 'parquet' and pyarrow is None:
+        raise ImportError('Parquet export requires pyarrow')
+    write, extension = writers[fmt]
+
+    os.makedirs(out_dir, exist_ok=True)
+    state_path = os.path.join(out_dir, state_file)
+    try:
+        with open(state_path) as infile:
+            state = json.load(infile)
+    except FileNotFoundError:
+        state = {'query': query, 'classified_at': None, 'last_id': None,
+                 'next_part': 0}
+    if state.get('query') != json.loads(json.dumps(query)):
+        raise ValueError(f'{out_dir} holds an export of a different query '
+                         f'({state.get("query")}), use a new directory')
+
+    after = None
+    if state['last_id'] is not None:
+        after = (state['classified_at'], state['last_id'])
+    query = incremental_query(query, after=after, until=time.time() - settle)
+
+    def flush(chunk):
+        path = os.path.join(out_dir,
+                            f'part-{state["next_part"]:05d}.{extension}')
+        atomic_write(path, lambda f: write(f, chunk))
+        state['classified_at'] = chunk[-1]['classified_at']
+        state['last_id'] = chunk[-1]['_id']
+        state['next_part'] += 1
+        atomic_write(state_path,
+                     lambda f: f.write(json.dumps(state).encode('utf-8')))
+        logging.info(f'Exported {len(chunk)} statuses to {path}')
+
+    n = 0
+    chunk = []
+    for row in iter_rows(database, query, batch_size):
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            flush(chunk)
+            n += len(chunk)
+            chunk = []
+    if len(chunk) > 0:
+        flush(chunk)
+        n += len(chunk)
+
+    return n
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export classified statuses')
+    parser.add_argument('out_dir', help='Directory for the exported chunks')
+    parser.add_argument('--db', default='active_stream')
+    parser.add_argument('--collection', default='dump')
+    parser.add_argument('--clf-version', type=int, default=None)
+    parser.add_argument('--relevant', dest='relevant', action='store_true',
+                        default=None)
+    parser.add_argument('--irrelevant', dest='relevant', action='store_false')
+    parser.add_argument('--sample', choices=['track', 'sample'], default=None)
+    parser.add_argument('--format', choices=list(writers), default='ndjson')
+    parser.add_argument('--chunk-size', type=int, default=100000)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--settle', type=float, default=60,
+                        help='Leave statuses classified within the last '
+                             'SETTLE seconds for the next export')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    database = MongoClient()[args.db][args.collection]
+    query = build_query(clf_version=args.clf_version, relevant=args.relevant,
+                        sample=args.sample)
+    try:
+        n = export(database, args.out_dir, query, fmt=args.format,
+                   chunk_size=args.chunk_size, batch_size=args.batch_size,
+                   settle=args.settle)
+    except ValueError as e:
+        parser.error(str(e))
+    logging.info(f'Done. Exported {n} statuses')
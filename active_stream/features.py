@@ -0,0 +1,110 @@
+import logging
+
+import numpy as np
+import scipy.sparse
+
+
+class FeatureMap(object):
+    '''
+    Maps dictionary token ids to the columns of a compacted feature space.
+
+    The stored bag of words representations always use dictionary ids. Models
+    are trained on the compacted space of a specific map version and carry
+    that map, so statuses are remapped when they are scored.
+
+    Arguments:
+    ---------------
+    version: int
+    index: np.array, dictionary id -> column or -1 for dropped tokens
+    '''
+
+    def __init__(self, version, index):
+        self.version = version
+        self.index = index
+        self.ids = np.flatnonzero(index >= 0)
+
+    @property
+    def n_features(self):
+        return len(self.ids)
+
+    def transform(self, corpus, dtype=np.float64):
+        '''
+        Convert a gensim corpus (list of bag of words) to a sparse document
+        by feature matrix. Dropped tokens and tokens added to the dictionary
+        after the map was computed are ignored.
+        '''
+        lengths = np.array([len(doc) for doc in corpus], dtype=np.int64)
+        indptr = np.zeros(len(corpus) + 1, dtype=np.int32)
+        if len(corpus) == 0 or lengths.sum() == 0:
+            return scipy.sparse.csr_matrix((len(corpus), self.n_features),
+                                           dtype=dtype)
+        pairs = np.array([pair for doc in corpus for pair in doc])
+        ids = pairs[:, 0]
+        columns = np.full(len(ids), -1, dtype=np.int32)
+        known = ids < len(self.index)
+        columns[known] = self.index[ids[known]]
+        keep = columns >= 0
+        rows = np.repeat(np.arange(len(corpus)), lengths)[keep]
+        indptr[1:] = np.cumsum(np.bincount(rows, minlength=len(corpus)))
+        return scipy.sparse.csr_matrix(
+                (pairs[keep, 1].astype(dtype), columns[keep], indptr),
+                shape=(len(corpus), self.n_features))
+
+
+class FeaturePruner(object):
+    '''
+    Computes compacted feature spaces from the document frequencies the
+    dictionary collects while statuses are processed. Tokens that occur in
+    fewer than `no_below` statuses or in more than a fraction `no_above` of
+    all statuses are dropped.
+
+    A new `FeatureMap` is only computed once the number of processed
+    statuses grew by a fraction `min_growth` since the last one.
+
+    Arguments:
+    ---------------
+    data: data structures, see app.py for details
+    no_below: int
+    no_above: float
+    min_growth: float
+    '''
+
+    def __init__(self, data, no_below=2, no_above=0.5, min_growth=0.1):
+        self.dictionary = data['dictionary']
+        self.dictionary_lock = data['locks']['dictionary']
+        self.no_below = no_below
+        self.no_above = no_above
+        self.min_growth = min_growth
+        self.feature_map = None
+        self.num_docs = 0
+
+    def update(self):
+        '''Returns the current FeatureMap, recomputed if necessary'''
+        num_docs = self.dictionary.num_docs
+        if (self.feature_map is not None and
+                num_docs < self.num_docs * (1 + self.min_growth)):
+            return self.feature_map
+
+        with self.dictionary_lock:
+            num_docs = self.dictionary.num_docs
+            dfs = self.dictionary.dfs
+            ids = np.fromiter(dfs.keys(), dtype=np.int64, count=len(dfs))
+            dfs = np.fromiter(dfs.values(), dtype=np.int64, count=len(dfs))
+            # Read after the document frequencies. A shared dictionary may
+            # grow in between, but never shrinks
+            n_tokens = len(self.dictionary)
+
+        keep = (dfs >= self.no_below) & (dfs <= self.no_above * num_docs)
+        if not keep.any():
+            # Too few statuses to prune, use the full dictionary
+            keep[:] = True
+        index = np.full(n_tokens, -1, dtype=np.int32)
+        kept_ids = np.sort(ids[keep])
+        index[kept_ids] = np.arange(len(kept_ids), dtype=np.int32)
+
+        version = 0 if self.feature_map is None else self.feature_map.version + 1
+        self.feature_map = FeatureMap(version, index)
+        self.num_docs = num_docs
+        logging.info(f'Feature map version {version}: kept '
+                     f'{len(kept_ids)} of {n_tokens} tokens')
+        return self.feature_map
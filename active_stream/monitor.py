@@ -3,11 +3,18 @@ import logging
 import queue
 import numpy as np
 
-from time import sleep
+from time import sleep, time
+from timeseries import TimeSeries
 
 class Monitor(threading.Thread):
     '''
-    Monitor basic data collection stats    
+    Monitor basic data collection stats of a topic
+
+    The stats are emitted to all clients of the topic namespace and recorded
+    in `timeseries`, which holds their history at several resolutions (see
+    `timeseries.TimeSeries`). The total count and rate include the statuses
+    shed or dropped on overflow by the admission controller, so they do not
+    fall when load shedding starts.
 
     Arguments:
     ---------------  
@@ -15,6 +22,8 @@ class Monitor(threading.Thread):
     streamer: threading.Thread
     classifier: threading.Thread
     annotator: threading.Thread
+    retention: retention.Retention or None. Expired statuses are included in
+        the total count
     
     Methods:
     ---------------  
@@ -22,27 +31,33 @@ class Monitor(threading.Thread):
 
     '''
 
-    def __init__(self, data, streamer, classifier, annotator):
-        super(Monitor, self).__init__(name='Monitor')
+    def __init__(self, data, streamer, classifier, annotator, retention=None):
+        super(Monitor, self).__init__(name=f'Monitor/{data["topic"]}')
         self.database = data['database']
         self.stoprequest = threading.Event()
         self.socket = data['socket']
+        self.namespace = data['namespace']
         self.mif_queue = data['queues']['most_important_features']
-        self.limit_queue = data['queues']['limit']
         self.mif = None
         self.streamer = streamer
         self.last_count = 0
         self.clf = classifier
         self.annotator = annotator
+        self.retention = retention
         self.counts = []
-        self.missed = 0
+        self.count_times = []
+        self.timeseries = TimeSeries(['rate', 'missed', 'shed', 'overflow',
+                                      'classified', 'f1', 'precision',
+                                      'recall'])
         self.message_queue = data['queues']['messages']
+        self.admission = data['admission']
         self.report_interval = 0.3
     
     def run(self):
         logging.debug('Ready!')
         while not self.stoprequest.isSet():
-            self.socket.emit('db_report', {'data': self.get_stats()})
+            self.socket.emit('db_report', {'data': self.get_stats()},
+                             namespace=self.namespace)
             sleep(self.report_interval)
         logging.debug('Stopped')
 
@@ -50,30 +65,39 @@ class Monitor(threading.Thread):
 
         d = self.database
         n_total = d.count({'sample': 'track'})
+        if self.retention is not None:
+            n_total += self.retention.expired['track']
+        # Statuses dropped by the admission controller were received too.
+        # They are not routed, with several topics each topic counts them
+        n_total += (self.admission.shed['track'] +
+                    self.admission.overflow['track'])
         n_sample = d.count({'sample': 'sample'})
         
-        # Calculate average per second rate for last minute
+        # Calculate average per second rate over the last five reports. The
+        # queries above take time, so the actual time between counts is used
+        now = time()
         self.counts.append(n_total)
+        self.count_times.append(now)
         n_counts = len(self.counts)
         if n_counts > 1:
-            avg_rate = round(np.mean(
-                np.diff(np.array(self.counts))), 1) * 1/self.report_interval
+            avg_rate = round((self.counts[-1] - self.counts[0]) /
+                             (self.count_times[-1] - self.count_times[0]), 1)
         else:
             avg_rate = np.nan
 
         if n_counts > 5:
             diff = n_counts - 5
             del self.counts[:diff]
+            del self.count_times[:diff]
             
-        # Get number of missed tweets
-        while not self.limit_queue.empty():
-            msg = self.limit_queue.get()
-            self.missed += msg['limit']['track']
+        # Missed tweets are counted by the streamer for all topics
+        missed = self.streamer.missed
         if not self.mif_queue.empty():
             self.mif = self.mif_queue.get()
             
         n_annotated = d.count({'manual_relevant': {'$ne': None}, 
-                               'sample': 'track'})
+                               'sample': 'track',
+                               'duplicate_of': None})
         current_clf_version = self.clf.clf_version
         n_classified = d.count({'classifier_relevant': True,
                                 'clf_version': {'$gte': current_clf_version}})
@@ -94,9 +118,21 @@ class Monitor(threading.Thread):
             messages.append(self.message_queue.get())
         
         metrics = self.get_clf_metrics()
+        self.timeseries.add(now, {
+            'rate': None if np.isnan(avg_rate) else avg_rate,
+            'missed': missed,
+            'shed': self.admission.shed['track'],
+            'overflow': self.admission.overflow['track'],
+            'classified': perc_classified,
+            'f1': self.numeric(metrics['f1_score']),
+            'precision': self.numeric(metrics['precision']),
+            'recall': self.numeric(metrics['recall'])
+            })
         return {'total_count': n_total,
                 'rate': avg_rate,
-                'missed': self.missed,
+                'missed': missed,
+                'shed': self.admission.shed['track'],
+                'overflow': self.admission.overflow['track'],
                 'annotated': n_annotated,
                 'classified': perc_classified,
                 'training_started': training_started,
@@ -108,6 +144,12 @@ class Monitor(threading.Thread):
                 'clf_version': current_clf_version
                 }
 
+    def numeric(self, value):
+        '''None for metrics that are not available yet'''
+        if value == 'NA':
+            return None
+        return value
+
     def get_clf_metrics(self):
         performance = self.annotator.clf_performance
         tp = performance['true_positive']
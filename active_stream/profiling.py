@@ -0,0 +1,96 @@
+import threading
+import tracemalloc
+import sys
+import os
+
+from collections import Counter
+from time import sleep, time
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return (f'{code.co_name} '
+            f'({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+
+
+def sample_stacks(seconds, interval=0.005, thread_names=None):
+    '''
+    Sampling profiler. Records the stacks of running threads every `interval`
+    seconds for `seconds` seconds.
+
+    thread_names: list of str, names of the threads to sample. All threads
+        except the calling one if None. Topic threads are named
+        '<thread>/<topic>', 'Classifier' selects the Classifiers of all
+        topics, 'Classifier/default' the one of topic default.
+
+    Returns a Counter of stacks in collapsed format (thread name and frames
+    from the outermost to the innermost, separated by ';').
+    '''
+    own = threading.get_ident()
+    stacks = Counter()
+    end = time() + seconds
+    while time() < end:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            name = names.get(ident)
+            if ident == own or name is None:
+                continue
+            if (thread_names is not None and name not in thread_names and
+                    name.split('/')[0] not in thread_names):
+                continue
+            frames = []
+            while frame is not None:
+                frames.append(frame_name(frame))
+                frame = frame.f_back
+            stacks[';'.join([name] + frames[::-1])] += 1
+        sleep(interval)
+    return stacks
+
+
+def collapsed(stacks):
+    '''Format stacks for flamegraph.pl / speedscope'''
+    return ''.join(f'{stack} {n}\n' for stack, n in stacks.most_common())
+
+
+def structure_sizes(data):
+    '''Sizes of the shared data structures that can grow'''
+    sizes = {'dictionary': len(data['dictionary'])}
+    for name, q in data['queues'].items():
+        if q is not None:
+            sizes[f'queue {name}'] = q.qsize()
+    for topic in data.get('topics', {}).values():
+        for name, q in topic.queues.items():
+            sizes[f'queue {topic.name}/{name}'] = q.qsize()
+    return sizes
+
+
+def memory_growth(data, seconds, top=25, nframes=1):
+    '''
+    Allocations that grew over `seconds` seconds, by source line, and the
+    sizes of the shared data structures before and after. Starts tracemalloc
+    if it is not already tracing.
+
+    Returns a plain text report.
+    '''
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start(nframes)
+    try:
+        sizes_before = structure_sizes(data)
+        before = tracemalloc.take_snapshot()
+        sleep(seconds)
+        after = tracemalloc.take_snapshot()
+        sizes_after = structure_sizes(data)
+    finally:
+        if started:
+            tracemalloc.stop()
+
+    lines = [f'Top {top} allocation sites by growth over {seconds}s:']
+    for stat in after.compare_to(before, 'lineno')[:top]:
+        lines.append(str(stat))
+    lines.append('')
+    lines.append('Shared data structures (before -> after):')
+    for name, size in sizes_after.items():
+        lines.append(f'{name}: {sizes_before.get(name)} -> {size}')
+    return '\n'.join(lines) + '\n'
+
@@ -0,0 +1,89 @@
+import json
+
+
+class Status(object):
+    '''
+    Compact in-flight representation of a status.
+
+    Holds only the parts of a status the pipeline works on. The raw JSON is
+    kept as bytes and only decoded again when the status is stored. Fields
+    added by the pipeline (classification, bag of words, ...) are accessed
+    with item access (`status['bow']`) and stored along with the raw status.
+
+    Attributes:
+    ---------------
+    id: int
+    text: str
+    screen_name: str, of the user
+    name: str, of the user
+    hashtags: tuple of (text, start, end)
+    urls: tuple of (url, expanded_url, start, end)
+    mentions: tuple of (screen_name, start, end)
+    retweeted_id: int, id of the retweeted status or None
+    raw: bytes, the JSON encoded status as received or None
+    fields: dict, fields added by the pipeline
+    '''
+
+    __slots__ = ['id', 'text', 'screen_name', 'name', 'hashtags', 'urls',
+                 'mentions', 'retweeted_id', 'raw', 'fields']
+
+    def __init__(self, id, text, screen_name, name, hashtags=(), urls=(),
+                 mentions=(), retweeted_id=None, raw=None):
+        self.id = id
+        self.text = text
+        self.screen_name = screen_name
+        self.name = name
+        self.hashtags = hashtags
+        self.urls = urls
+        self.mentions = mentions
+        self.retweeted_id = retweeted_id
+        self.raw = raw
+        self.fields = {}
+
+    @classmethod
+    def from_dict(cls, status, raw=None):
+        '''
+        Create a record from a decoded status, as received from the API or
+        stored in the database.
+
+        status: dict
+        raw: bytes, the JSON encoded status
+        '''
+        entities = status['entities']
+        try:
+            retweeted_id = status['retweeted_status']['id']
+        except KeyError:
+            retweeted_id = None
+        return cls(id=status['id'],
+                   text=status['text'],
+                   screen_name=status['user']['screen_name'],
+                   name=status['user']['name'],
+                   hashtags=tuple((ht['text'], ht['indices'][0],
+                                   ht['indices'][1])
+                                  for ht in entities['hashtags']),
+                   urls=tuple((url['url'], url['expanded_url'],
+                               url['indices'][0], url['indices'][1])
+                              for url in entities['urls']),
+                   mentions=tuple((user['screen_name'], user['indices'][0],
+                                   user['indices'][1])
+                                  for user in entities['user_mentions']),
+                   retweeted_id=retweeted_id,
+                   raw=raw)
+
+    def __getitem__(self, key):
+        return self.fields[key]
+
+    def __setitem__(self, key, value):
+        self.fields[key] = value
+
+    def __contains__(self, key):
+        return key in self.fields
+
+    def get(self, key, default=None):
+        return self.fields.get(key, default)
+
+    def document(self):
+        '''The full status with all pipeline fields, for storage'''
+        doc = json.loads(self.raw.decode('utf-8'))
+        doc.update(self.fields)
+        return doc
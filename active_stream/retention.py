@@ -0,0 +1,157 @@
+import threading
+import logging
+import gzip
+import os
+
+from datetime import datetime, timedelta
+from bson import ObjectId, json_util
+
+
+class Retention(threading.Thread):
+    '''
+    Keeps the working set of the status collection bounded.
+
+    Periodically applies the following policies. Each one is disabled if its
+    parameter is None. The age of a status is taken from its ObjectId.
+    - Expiry of statuses from the sample stream older than `sample_ttl` or
+      beyond the newest `max_sample` ones.
+    - Expiry of track statuses that are not annotated and classified as
+      irrelevant with probability_relevant < `irrelevant_threshold` and older
+      than `irrelevant_ttl`.
+    - Compaction of statuses older than `compact_after`. The raw status is
+      appended to a gzip compressed file in `archive_dir` (one JSON document
+      per line, one file per day), then all fields except the bag of words
+      representation and the classification are removed from the database.
+      Compacted statuses are no longer offered for annotation.
+
+    Annotated track statuses are never expired or compacted.
+
+    Arguments:
+    ---------------
+    data: data structures, see app.py for details
+    archive_dir: str, directory for the compressed raw statuses
+    sample_ttl: float, seconds
+    max_sample: int
+    irrelevant_ttl: float, seconds
+    irrelevant_threshold: float
+    compact_after: float, seconds
+    interval: float, seconds between runs
+    batch_size: int, maximum number of statuses compacted per run
+    '''
+
+    # Fields kept on compaction
+    keep_fields = set(['_id', 'id', 'bow', 'dict_size', 'sample',
+                       'classifier_relevant', 'manual_relevant',
+                       'probability_relevant', 'annotation_priority',
+                       'clf_version', 'classified_at', 'duplicate_of',
+                       'n_duplicates', 'prefilter_probability',
+                       'prefilter_explored', 'sampling_weight',
+                       'lease_owner', 'lease_expires', 'compacted'])
+
+    def __init__(self, data, archive_dir, sample_ttl=None, max_sample=None,
+                 irrelevant_ttl=None, irrelevant_threshold=0.05,
+                 compact_after=None, interval=60, batch_size=10000):
+        super(Retention, self).__init__(name=f'Retention/{data["topic"]}')
+        self.database = data['database']
+        self.stoprequest = threading.Event()
+        self.archive_dir = archive_dir
+        self.sample_ttl = sample_ttl
+        self.max_sample = max_sample
+        self.irrelevant_ttl = irrelevant_ttl
+        self.irrelevant_threshold = irrelevant_threshold
+        self.compact_after = compact_after
+        self.interval = interval
+        self.batch_size = batch_size
+        self.expired = {'track': 0, 'sample': 0}
+        self.n_compacted = 0
+        os.makedirs(archive_dir, exist_ok=True)
+
+    def run(self):
+        logging.debug('Ready!')
+        while not self.stoprequest.wait(self.interval):
+            try:
+                self.apply()
+            except Exception as e:
+                logging.error(f'Error applying retention policies: {e}')
+        logging.debug('Stopped')
+
+    def cutoff(self, seconds):
+        '''ObjectId of a status inserted `seconds` ago'''
+        return ObjectId.from_datetime(datetime.utcnow() -
+                                      timedelta(seconds=seconds))
+
+    def apply(self):
+        '''Apply all retention policies once'''
+        if self.sample_ttl is not None:
+            self.expire('sample', {'sample': 'sample',
+                                   '_id': {'$lt': self.cutoff(self.sample_ttl)}})
+
+        if self.max_sample is not None:
+            oldest_kept = list(self.database.find({'sample': 'sample'},
+                                                  projection=['_id'])
+                                            .sort('_id', -1)
+                                            .skip(self.max_sample)
+                                            .limit(1))
+            if len(oldest_kept) > 0:
+                self.expire('sample', {'sample': 'sample',
+                                       '_id': {'$lte': oldest_kept[0]['_id']}})
+
+        if self.irrelevant_ttl is not None:
+            self.expire('track', {
+                'sample': 'track',
+                'manual_relevant': None,
+                'probability_relevant': {'$lt': self.irrelevant_threshold},
+                '_id': {'$lt': self.cutoff(self.irrelevant_ttl)}})
+
+        if self.compact_after is not None:
+            self.compact(self.cutoff(self.compact_after))
+
+    def expire(self, sample, query):
+        result = self.database.delete_many(query)
+        if result.deleted_count > 0:
+            logging.info(f'Expired {result.deleted_count} {sample} statuses')
+        self.expired[sample] += result.deleted_count
+
+    def archive_path(self):
+        name = datetime.utcnow().strftime('dump-%Y%m%d.ndjson.gz')
+        return os.path.join(self.archive_dir, name)
+
+    def compact(self, cutoff):
+        '''
+        Archive and compact up to `batch_size` statuses inserted before the
+        `cutoff` ObjectId. Statuses leased for annotation are skipped, the
+        annotation needs their raw fields.
+        '''
+        query = {'_id': {'$lt': cutoff},
+                 'compacted': {'$ne': True},
+                 'lease_owner': None,
+                 '$or': [{'sample': 'sample'}, {'manual_relevant': None}]}
+        batch = list(self.database.find(query).sort('_id', 1)
+                                              .limit(self.batch_size))
+        if len(batch) == 0:
+            return
+
+        # Write the raw statuses before removing them from the database. If
+        # the process dies in between they are archived again on the next run
+        with gzip.open(self.archive_path(), 'ab') as archive:
+            for status in batch:
+                archive.write(json_util.dumps(status).encode('utf-8'))
+                archive.write(b'\n')
+
+        bulk = self.database.initialize_unordered_bulk_op()
+        for status in batch:
+            unset = {field: '' for field in status
+                     if field not in self.keep_fields}
+            update = {'$set': {'compacted': True}}
+            if len(unset) > 0:
+                update['$unset'] = unset
+            # The status may have been leased since it was read
+            bulk.find({'_id': status['_id'],
+                       'lease_owner': None}).update_one(update)
+        result = bulk.execute()
+        self.n_compacted += result['nModified']
+        logging.info(f'Compacted {result["nModified"]} statuses')
+
+    def join(self, timeout=None):
+        self.stoprequest.set()
+        super(Retention, self).join(timeout)
@@ -0,0 +1,187 @@
+import threading
+import logging
+import pickle
+import json
+import os
+
+from gensim import corpora
+
+
+def atomic_write(path, write):
+    '''
+    Write a file atomically. `write` is called with a binary file handle to a
+    temporary file which replaces `path` once it is completely written.
+    '''
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as outfile:
+        write(outfile)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    os.replace(tmp_path, path)
+
+
+def load_dictionary(directory):
+    '''Load the dictionary snapshot from `directory`'''
+    return corpora.Dictionary.load(os.path.join(directory, 'dictionary.bin'))
+
+
+class Snapshotter(threading.Thread):
+    '''
+    Periodically writes the in-memory session state to `directory` so that a
+    collection can be resumed after a restart (see `app.py --resume`).
+
+    The snapshot consists of:
+    - dictionary.bin: the gensim dictionary (binary pickle)
+    - state.json: counters of the shared threads
+    - <topic>/model.pkl: the model currently used by the Classifier of a topic
+    - <topic>/prefilter.pkl: the prefilter currently used by the
+      TextProcessor for a topic, once one has been trained
+    - <topic>/state.json: counters of the topic threads and its keywords
+
+    Every file is written to a temporary file first and then moved into place,
+    so a crash during a snapshot never leaves a corrupted file behind.
+
+    Arguments:
+    ---------------
+    data: data structures, see app.py for details
+    streamer: threading.Thread
+    text_processor: text_processing.TextProcessor
+    topics: list of topics.Topic, with their threads set up
+    directory: str, directory to store the snapshots in
+    interval: float, seconds between snapshots
+    '''
+
+    def __init__(self, data, streamer, text_processor, topics, directory,
+                 interval=60):
+        super(Snapshotter, self).__init__(name='Snapshotter')
+        self.stoprequest = threading.Event()
+        self.dictionary = data['dictionary']
+        self.dictionary_lock = data['locks']['dictionary']
+        self.streamer = streamer
+        self.text_processor = text_processor
+        self.topics = topics
+        self.directory = directory
+        self.interval = interval
+        # topic name -> model / prefilter in the last snapshot
+        self.last_models = {}
+        self.last_prefilters = {}
+        for topic in topics:
+            os.makedirs(self.path(topic.name), exist_ok=True)
+
+    def run(self):
+        logging.debug('Ready!')
+        while not self.stoprequest.wait(self.interval):
+            try:
+                self.snapshot()
+            except Exception as e:
+                logging.error(f'Error writing snapshot: {e}')
+        logging.debug('Stopped')
+
+    def path(self, *names):
+        return os.path.join(self.directory, *names)
+
+    def snapshot(self):
+        '''Write the current state to disk'''
+        logging.debug('Writing snapshot')
+        # The dictionary is written before the state file. On resume all
+        # statuses that were processed after the dictionary snapshot can then
+        # be identified by their `dict_size`
+        with self.dictionary_lock:
+            atomic_write(self.path('dictionary.bin'),
+                         lambda f: self.dictionary.save(
+                             f, pickle_protocol=pickle.HIGHEST_PROTOCOL))
+
+        state = {'missed': self.streamer.missed}
+        atomic_write(self.path('state.json'),
+                     lambda f: f.write(json.dumps(state).encode('utf-8')))
+
+        for topic in self.topics:
+            self.snapshot_topic(topic)
+
+    def snapshot_topic(self, topic):
+        '''Write the state of the threads of a topic to disk'''
+        # Only write the model if it changed since the last snapshot
+        clf = topic.classifier.clf
+        if clf is not self.last_models.get(topic.name):
+            atomic_write(self.path(topic.name, 'model.pkl'),
+                         lambda f: pickle.dump(clf, f,
+                                               pickle.HIGHEST_PROTOCOL))
+            self.last_models[topic.name] = clf
+
+        prefilter = self.text_processor.prefilters[topic.name]
+        if (prefilter is not None and
+                prefilter is not self.last_prefilters.get(topic.name)):
+            atomic_write(self.path(topic.name, 'prefilter.pkl'),
+                         lambda f: pickle.dump(prefilter, f,
+                                               pickle.HIGHEST_PROTOCOL))
+            self.last_prefilters[topic.name] = prefilter
+
+        annotator = topic.annotator
+        state = {
+                'keywords': sorted(topic.keywords),
+                'classifier_version': topic.classifier.clf_version,
+                'trainer_version': topic.trainer.clf_version,
+                'n_positive': int(annotator.n_positive),
+                'n_negative': int(annotator.n_negative),
+                'n_trainer_triggered': annotator.n_trainer_triggered,
+                'clf_performance': annotator.clf_performance,
+                'suggested_features': topic.monitor.mif,
+                'expired': topic.retention.expired
+                }
+        atomic_write(self.path(topic.name, 'state.json'),
+                     lambda f: f.write(json.dumps(state).encode('utf-8')))
+
+    def restore(self):
+        '''
+        Restore the state of all threads from the last snapshot. Must be called
+        before the threads are started. The dictionary is restored separately
+        with `load_dictionary()` before it is passed to the threads.
+        '''
+        with open(self.path('state.json'), 'rb') as infile:
+            state = json.loads(infile.read().decode('utf-8'))
+        self.streamer.missed = state['missed']
+
+        for topic in self.topics:
+            try:
+                self.restore_topic(topic)
+            except FileNotFoundError:
+                logging.info(f'No snapshot of topic {topic.name}, '
+                             'starting it fresh')
+
+    def restore_topic(self, topic):
+        '''Restore the state of the threads of a topic'''
+        with open(self.path(topic.name, 'state.json'), 'rb') as infile:
+            state = json.loads(infile.read().decode('utf-8'))
+
+        with open(self.path(topic.name, 'model.pkl'), 'rb') as infile:
+            clf = pickle.load(infile)
+        topic.classifier.clf = clf
+        self.last_models[topic.name] = clf
+
+        try:
+            with open(self.path(topic.name, 'prefilter.pkl'), 'rb') as infile:
+                prefilter = pickle.load(infile)
+            self.text_processor.prefilters[topic.name] = prefilter
+            self.last_prefilters[topic.name] = prefilter
+        except FileNotFoundError:
+            logging.info(f'No prefilter in snapshot of topic {topic.name}')
+
+        topic.keywords.update(state['keywords'])
+        topic.classifier.clf_version = state['classifier_version']
+        topic.trainer.clf_version = state['trainer_version']
+        annotator = topic.annotator
+        annotator.n_positive = state['n_positive']
+        annotator.n_negative = state['n_negative']
+        annotator.n_trainer_triggered = state['n_trainer_triggered']
+        annotator.clf_performance.update(state['clf_performance'])
+        annotator.clear_leases()
+        topic.monitor.mif = state['suggested_features']
+        # Snapshots of earlier versions lack the retention counters
+        topic.retention.expired.update(state.get('expired', {}))
+        logging.info(f'Restored snapshot of topic {topic.name} (model version '
+                     f'{topic.classifier.clf_version}, '
+                     f'keywords: {state["keywords"]})')
+
+    def join(self, timeout=None):
+        self.stoprequest.set()
+        super(Snapshotter, self).join(timeout)
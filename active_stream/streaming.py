@@ -1,18 +1,26 @@
 import tweepy
 import threading
 import logging
+import queue
 import time
 import json
 
 import numpy as np
 
+from records import Status
+from transport import put_latest
+
 
 class Listener(tweepy.StreamListener):
     '''
     Tweepy stream listener
 
-    Grabs statuses from the Twitter streaming API, adds fields required for the
-    application, filters irrelevant ones and passes them to the text processor.
+    Grabs statuses from the Twitter streaming API, filters irrelevant ones,
+    converts them to compact `records.Status` objects, adds fields required for
+    the application and passes them to the text processor.
+    Statuses are passed on only if the admission controller admits them and
+    the listener never blocks on a full queue, so the stream connection is not
+    stalled when the pipeline falls behind.
 
     Arguments:
     data: all data structures. See app.py for details
@@ -24,10 +32,12 @@ class Listener(tweepy.StreamListener):
         self.tp_queue = data['queues']['text_processing']
         self.keyword_queue = data['queues']['keywords']
         self.limit_queue = data['queues']['limit']
-        self.message_queue = data['queues']['messages']
+        self.topics = data['topics']
+        self.admission = data['admission']
 
     def on_data(self, data):
-        doc = json.loads(data.strip('\n'))
+        data = data.strip('\n')
+        doc = json.loads(data)
         if 'limit' in doc:
             self.limit_queue.put(doc)
             return True
@@ -38,13 +48,21 @@ class Listener(tweepy.StreamListener):
         if status is None:
             return True
         else:
+            status = Status.from_dict(status, raw=data.encode('utf-8'))
             status = self.amend_status(status)
-            self.tp_queue.put(status)
+            if not self.admission.admit(status):
+                return True
+            try:
+                self.tp_queue.put_nowait(status)
+            except queue.Full:
+                self.admission.record_overflow(status)
             return True
 
     def on_error(self, status):
         logging.error(f'Received error message from API: {status}')
-        self.message_queue.put(f'Received error message form Twitter API: {status}')
+        for topic in self.topics.values():
+            put_latest(topic.data['queues']['messages'],
+                       f'Received error message form Twitter API: {status}')
         return False
 
     def amend_status(self, status):
@@ -55,6 +73,7 @@ class Listener(tweepy.StreamListener):
         status['annotation_priority'] = 0
         status['clf_version'] = -1
         status['sample'] = 'track'
+        status['duplicate_of'] = None
 
         return status
 
@@ -76,6 +95,7 @@ class SampleListener(Listener):
         status['annotation_priority'] = 0
         status['clf_version'] = -1
         status['sample'] = 'sample'
+        status['duplicate_of'] = None
 
         return status
 
@@ -84,6 +104,11 @@ class Streamer(threading.Thread):
     '''Connects to Twitter API and directs incoming statuses to the respective 
     queues.
 
+    Tracks the union of the keywords of all topics (`data['topics']`).
+    Keyword requests in `queues['keywords']` name the topic they apply to.
+    The number of statuses the API could not deliver (limit notices) is
+    counted in `missed`.
+
     Arguments:
     --------------
     keyword_monitor: dict, containing all keywords as `Keyword()` objects
@@ -98,7 +123,7 @@ class Streamer(threading.Thread):
         self.stoprequest = threading.Event()
         self.filter_params = data['filters']
         self.keyword_queue = data['queues']['keywords']
-        self.keywords = set()
+        self.topics = data['topics']
         self.auth_track = tweepy.OAuthHandler(credentials_track['consumer_key'], 
                                         credentials_track['consumer_secret'])
         self.auth_track.set_access_token(credentials_track['access_token'],
@@ -108,10 +133,18 @@ class Streamer(threading.Thread):
         self.auth_sample.set_access_token(credentials_sample['access_token'],
                                    credentials_sample['access_token_secret'])
         self.limit_queue = data['queues']['limit']
-        self.message_queue = data['queues']['messages']
+        self.missed = 0
         self.last_connection = 0
         self.min_reconnect_pause = 20
 
+    @property
+    def keywords(self):
+        '''Union of the keywords of all topics'''
+        keywords = set()
+        for topic in self.topics.values():
+            keywords.update(topic.keywords)
+        return keywords
+
     def run(self):
         logging.debug('Ready!')
         while not self.stoprequest.isSet():
@@ -144,6 +177,11 @@ class Streamer(threading.Thread):
                     except UnboundLocalError as e:
                         logging.error(f'Error disconnecting stream: {e}')
                     break
+
+                # Get number of missed tweets
+                while not self.limit_queue.empty():
+                    msg = self.limit_queue.get()
+                    self.missed += msg['limit']['track']
                 
                 # Get all new additions / deletions
                 if not self.keyword_queue.empty():
@@ -155,10 +193,11 @@ class Streamer(threading.Thread):
                     # Get consolidated list
                     for request in requests:
                         word = request['word']
+                        topic = self.topics[request['topic']]
                         if request['add']:
-                            self.keywords.update([word])
+                            topic.keywords.update([word])
                         else:
-                            self.keywords.remove(word)
+                            topic.keywords.discard(word)
 
                     # Disconnect stream and break to jump to reconnect
                     try:
@@ -166,7 +205,9 @@ class Streamer(threading.Thread):
                     except UnboundLocalError:
                         logging.error('UnboundLocalError ignored')
                         pass
-                    self.message_queue.put('Keyword changes applied!')
+                    for name in set(r['topic'] for r in requests):
+                        put_latest(self.topics[name].data['queues']['messages'],
+                                   'Keyword changes applied!')
                     break
                 
                 time_since = time.time() - self.last_connection
@@ -5,7 +5,12 @@ import queue
 import re
 import string
 
+import numpy as np
+
+from time import time
 from urllib.parse import urlparse
+from records import Status
+from topics import route
 
 class TextProcessor(threading.Thread):
     '''
@@ -13,20 +18,55 @@ class TextProcessor(threading.Thread):
     counts. Embedds status text in word2vec space and appends embedded
     representation to status object.
 
+    Retweets, copies and near-duplicates of track statuses (see
+    `dedup.Deduplicator`) are not parsed again. They are stored with the bag of
+    words of the canonical status of their cluster, the id of the canonical
+    status in `duplicate_of` and its current classification. Classifier and
+    Annotator only process canonical statuses and propagate their results to
+    the duplicates.
+
+    Statuses are routed to the topics they belong to (see `topics.route()`)
+    and stored in the collection of each topic. The text of a status is only
+    tokenized once, no matter how many topics it belongs to.
+
+    Once the `Trainer` of a topic provides a `classification.Prefilter` in
+    its `queues['prefilter_model']`, track statuses the prefilter considers
+    clearly irrelevant are stored in that topic without their bag of words:
+    with `bow` set to None and the prefilter probability as classification.
+    Statuses discarded by the prefilters of all their topics are not parsed.
+    A random fraction of the statuses a prefilter rejects is processed anyway
+    (see `classification.Prefilter`).
+
+    Every stored status carries the time it was stored in `classified_at`,
+    which the Classifier and Annotator update together with the
+    classification (see export.py).
+
+    In distributed mode (see distributed.py) `data['dictionary']` is a
+    `transport.SharedDictionary` that assigns the token ids for all workers.
+
     Arguments:
     --------------- 
     data: data structures see app.py for details
+    deduplicator: dedup.Deduplicator or None to disable duplicate detection
     '''
 
-    def __init__(self, data):
+    # Fields copied from the canonical status to its duplicates
+    cluster_fields = ['probability_relevant', 'classifier_relevant',
+                      'manual_relevant', 'annotation_priority', 'clf_version']
+
+    def __init__(self, data, deduplicator=None):
         super(TextProcessor, self).__init__(name='Text Processor')
         self.parser = spacy.load('en', disable=['parser', 'ner', 'tagger'])
         self.tp_queue = data['queues']['text_processing']
-        self.database = data['database']
+        self.topics = list(data['topics'].values())
         self.stoprequest = threading.Event()
         self.stoplist = set()
         self.dictionary = data['dictionary']
+        self.dictionary_lock = data['locks']['dictionary']
         self.repl = ['\\', '/', '-']
+        self.deduplicator = deduplicator
+        self.prefilters = {topic.name: None for topic in self.topics}
+        self.admission = data['admission']
 
     def remove_text_by_idx(self, text, indices):
         '''
@@ -48,46 +88,40 @@ class TextProcessor(threading.Thread):
 
         Arguments:
         ---------------   
-        status: dict, the tweet to process
+        status: records.Status, the tweet to process
         '''
         
         # Collect all fields of the tweet that might contain information on
         # content
 
         # Fields that allways exist
-        screen_name = status['user']['screen_name']
-        name = status['user']['name']
-        text = status['text']
+        screen_name = status.screen_name
+        name = status.name
+        text = status.text
 
         # Entities
         ## Hashtags:
-        hashtags = status['entities']['hashtags']
         out_hashtags = []
         idxs = []
-        if len(hashtags) > 0:
-            for ht in hashtags:
-                out_hashtags.append('#' + ht['text'])
-                idxs.append(ht['indices'])
+        for ht_text, start, end in status.hashtags:
+            out_hashtags.append('#' + ht_text)
+            idxs.append((start, end))
 
         ## urls 
-        urls = status['entities']['urls']
         out_urls = []
-        if len(urls) > 0:
-            for url in urls:
-                if url['url'] == '':
-                    continue
-                parsed = urlparse(url['expanded_url'])
-                path = parsed[2].translate({ord(c):' ' for c in self.repl})
-                out_urls.extend([parsed[1]] + path.split(' '))
-                idxs.append(url['indices'])
+        for url, expanded_url, start, end in status.urls:
+            if url == '':
+                continue
+            parsed = urlparse(expanded_url)
+            path = parsed[2].translate({ord(c):' ' for c in self.repl})
+            out_urls.extend([parsed[1]] + path.split(' '))
+            idxs.append((start, end))
 
         ## user_mentions 
-        users = status['entities']['user_mentions']
         out_users = []
-        if len(users) > 0:
-            for user in users:
-                out_users.append('@' + user['screen_name'])
-                idxs.append(user['indices'])
+        for user_screen_name, start, end in status.mentions:
+            out_users.append('@' + user_screen_name)
+            idxs.append((start, end))
                    
         # Remove entities from text
         text = self.remove_text_by_idx(text, idxs)
@@ -100,29 +134,147 @@ class TextProcessor(threading.Thread):
         info = (lemmas + [screen_name] + [name] + out_hashtags + out_urls + 
                 out_users)
         
-        l_0 = len(self.dictionary)
-        status['bow'] = self.dictionary.doc2bow(info, allow_update=True)
-        l_1 = len(self.dictionary)
-        status['dict_size'] = l_1
-
-        # Get id -> tokn mapping
-        if l_1 > l_0:
-            self.dictionary.id2token = {v: k 
-                                        for k, v 
-                                        in self.dictionary.token2id.items()}
+        with self.dictionary_lock:
+            status['bow'] = self.dictionary.doc2bow(info, allow_update=True)
+            status['dict_size'] = len(self.dictionary)
         return status
 
 
+    def prefilter_text(self, topic, status):
+        '''
+        Classify a status with the prefilter of a topic. If it is clearly
+        irrelevant return the classification fields to store it with, otherwise
+        return None. Rejected statuses picked for exploration are processed in
+        full, they are only marked.
+        '''
+        prefilter = self.prefilters[topic.name]
+        if prefilter is None:
+            return None
+
+        prob = prefilter.predict_proba(status)
+        if prob >= prefilter.threshold:
+            return None
+        if np.random.random() < prefilter.explore:
+            return {'prefilter_probability': prob,
+                    'prefilter_explored': True}
+
+        return {'bow': None,
+                'dict_size': len(self.dictionary),
+                'prefilter_probability': prob,
+                'probability_relevant': prob,
+                'classifier_relevant': False,
+                'annotation_priority': (prob - 0.5)**2}
+
+    def insert_duplicate(self, topic, doc, cluster):
+        '''
+        Store a duplicate status with the representation and classification of
+        the canonical status of its cluster.
+
+        topic: topics.Topic
+        doc: dict, the duplicate status as returned by `Status.document()`
+        cluster: dict, the cluster as returned by `Deduplicator.match()`
+        '''
+        database = topic.data['database']
+        doc['bow'] = cluster['bow']
+        doc['dict_size'] = cluster['dict_size']
+        doc['classified_at'] = time()
+
+        canonical = database.find_one_and_update(
+                {'id': cluster['id'], 'duplicate_of': None},
+                {'$inc': {'n_duplicates': 1}},
+                projection=self.cluster_fields)
+        if canonical is not None:
+            doc['duplicate_of'] = cluster['id']
+            for field in self.cluster_fields:
+                doc[field] = canonical[field]
+        # If the canonical status is not stored in this topic (it was routed to
+        # other topics only or expired), the status becomes canonical itself
+        database.insert(doc)
+
+    def reprocess(self, query):
+        '''
+        Re-tokenize statuses already stored in the database and update their
+        bag of words representation. Used on resume to re-assign token ids of
+        statuses processed after the last dictionary snapshot.
+
+        query: dict, MongoDB query selecting the statuses to reprocess.
+            Compacted statuses are skipped, they lack the raw fields
+        '''
+        query = dict(query, compacted={'$ne': True})
+        n = 0
+        for topic in self.topics:
+            database = topic.data['database']
+            for doc in database.find(query):
+                status = self.process_text(Status.from_dict(doc))
+                database.update({'_id': doc['_id']},
+                                {'$set': {'bow': status['bow'],
+                                          'dict_size': status['dict_size']}})
+                n += 1
+        logging.info(f'Reprocessed {n} statuses')
+
+    def process_status(self, status):
+        '''Process a status from the queue and store it in its topics'''
+        topics = route(status, self.topics)
+        if status['sample'] != 'track':
+            status = self.process_text(status)
+            doc = status.document()
+            doc['classified_at'] = time()
+            for topic in topics:
+                topic.data['database'].insert(dict(doc))
+            return
+
+        if self.deduplicator is not None:
+            signature = self.deduplicator.signature(status)
+            cluster = self.deduplicator.match(signature)
+            if cluster is not None:
+                doc = status.document()
+                for topic in topics:
+                    self.insert_duplicate(topic, dict(doc), cluster)
+                return
+
+        prefiltered = {}
+        for topic in topics:
+            fields = self.prefilter_text(topic, status)
+            if fields is not None:
+                prefiltered[topic.name] = fields
+
+        # Statuses picked for exploration are only marked, rejected statuses
+        # are stored without a bag of words
+        n_rejected = sum(1 for fields in prefiltered.values()
+                         if 'bow' in fields)
+        if n_rejected < len(topics):
+            status = self.process_text(status)
+        else:
+            status['bow'] = None
+            status['dict_size'] = len(self.dictionary)
+        doc = status.document()
+        doc['classified_at'] = time()
+        for topic in topics:
+            topic_doc = dict(doc)
+            topic_doc.update(prefiltered.get(topic.name, {}))
+            topic.data['database'].insert(topic_doc)
+
+        if self.deduplicator is not None:
+            self.deduplicator.add(signature, status)
+
     def run(self):
         logging.debug('Ready!')
         while not self.stoprequest.isSet():
             try:
                 status = self.tp_queue.get(True, 1)
-                status = self.process_text(status)
-                self.database.insert(status)
             except queue.Empty:
                 continue
 
+            for topic in self.topics:
+                prefilter_queue = topic.data['queues']['prefilter_model']
+                if not prefilter_queue.empty():
+                    self.prefilters[topic.name] = prefilter_queue.get()
+                    logging.info(f'Received new prefilter ({topic.name})')
+
+            start = time()
+            self.process_status(status)
+            self.admission.observe_latency(time() - start)
+
         logging.debug('Stopped')
 
     def join(self, timeout=None):
@@ -0,0 +1,107 @@
+import threading
+
+import numpy as np
+
+
+class RingBuffer(object):
+    '''
+    Fixed size buffer of timestamped observations of several metrics, backed
+    by numpy arrays. Once full, new observations overwrite the oldest ones.
+
+    Arguments:
+    ---------------
+    capacity: int, number of observations kept
+    n_metrics: int, number of values per observation
+    '''
+
+    def __init__(self, capacity, n_metrics):
+        self.capacity = capacity
+        self.timestamps = np.zeros(capacity)
+        self.values = np.full((capacity, n_metrics), np.nan)
+        self.n = 0
+
+    def append(self, timestamp, values):
+        i = self.n % self.capacity
+        self.timestamps[i] = timestamp
+        self.values[i] = values
+        self.n += 1
+
+    def get(self):
+        '''Returns (timestamps, values) ordered from oldest to newest'''
+        if self.n <= self.capacity:
+            return self.timestamps[:self.n], self.values[:self.n]
+        order = np.roll(np.arange(self.capacity), -(self.n % self.capacity))
+        return self.timestamps[order], self.values[order]
+
+
+class TimeSeries(object):
+    '''
+    Stores the history of a set of metrics at several resolutions.
+
+    Observations are averaged over buckets of `resolution` seconds. Each
+    resolution keeps its own `RingBuffer`, so the memory use is fixed and a
+    long history is available at coarse resolution.
+
+    Arguments:
+    ---------------
+    metrics: list of str, names of the recorded metrics
+    resolutions: list of tuples (bucket length in seconds, number of buckets)
+    '''
+
+    def __init__(self, metrics, resolutions=((1, 600), (60, 1440),
+                                             (3600, 24 * 14))):
+        self.metrics = list(metrics)
+        self.lock = threading.Lock()
+        self.levels = []
+        for resolution, capacity in resolutions:
+            self.levels.append({'resolution': resolution,
+                                'buffer': RingBuffer(capacity,
+                                                     len(self.metrics)),
+                                'bucket': None,
+                                'sum': np.zeros(len(self.metrics)),
+                                'count': np.zeros(len(self.metrics))})
+
+    def add(self, timestamp, values):
+        '''
+        Record an observation.
+
+        timestamp: float, seconds since the epoch
+        values: dict, metric name -> number. Missing or None values are
+            treated as not observed.
+        '''
+        x = np.array([np.nan if values.get(m) is None else values[m]
+                      for m in self.metrics], dtype=float)
+        observed = ~np.isnan(x)
+        with self.lock:
+            for level in self.levels:
+                bucket = timestamp // level['resolution']
+                if level['bucket'] is not None and bucket != level['bucket']:
+                    self.flush(level)
+                level['bucket'] = bucket
+                level['sum'][observed] += x[observed]
+                level['count'][observed] += 1
+
+    def flush(self, level):
+        '''Write the mean of the current bucket to the ring buffer'''
+        with np.errstate(invalid='ignore'):
+            mean = level['sum'] / level['count']
+        level['buffer'].append(level['bucket'] * level['resolution'], mean)
+        level['sum'][:] = 0
+        level['count'][:] = 0
+
+    def history(self):
+        '''
+        All completed buckets at every resolution in a JSON serializable
+        format: {resolution: {'time': [...], metric: [...], ...}}. Missing
+        values are None.
+        '''
+        out = {}
+        with self.lock:
+            for level in self.levels:
+                timestamps, values = level['buffer'].get()
+                series = {'time': timestamps.tolist()}
+                for i, metric in enumerate(self.metrics):
+                    series[metric] = [None if np.isnan(v) else v
+                                      for v in values[:, i].tolist()]
+                out[str(level['resolution'])] = series
+        return out
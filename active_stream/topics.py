@@ -0,0 +1,101 @@
+import re
+
+from transport import LocalTransport
+
+
+class Topic(object):
+    '''
+    A research topic tracked within the shared ingestion pipeline.
+
+    All topics share one `Streamer` (tracking the union of their keywords),
+    one `TextProcessor` and one dictionary. Each topic has its own collection,
+    model (`Trainer`, `Classifier`), `Annotator`, `Monitor`, `Retention` and
+    Socket.IO namespace. The topic threads are constructed with `topic.data`,
+    a copy of the shared data structures with the topic specific entries
+    replaced.
+
+    Arguments:
+    ---------------
+    name: str, name of the topic. Also used as Socket.IO namespace `/<name>`
+    data: shared data structures, see app.py for details
+    database: MongoDB collection of the topic
+    buf_size: int, maximum size of the topic queues
+    transport: transport.LocalTransport or transport.SocketTransport the
+        topic queues and events are created with. Defaults to local queues
+    '''
+
+    _token_pattern = re.compile(r'\w+')
+
+    def __init__(self, name, data, database, buf_size, transport=None):
+        if transport is None:
+            transport = LocalTransport()
+        self.name = name
+        self.namespace = '/' + name
+        self.keywords = set()
+        sizes = {'model': 1,
+                 'prefilter_model': 1,
+                 'annotation_response': buf_size,
+                 'most_important_features': 1,
+                 'messages': buf_size}
+        self.queues = {q: transport.queue(f'{name}/{q}', maxsize)
+                       for q, maxsize in sizes.items()}
+        self.data = dict(data)
+        self.data['database'] = database
+        self.data['queues'] = dict(data['queues'], **self.queues)
+        self.data['events'] = {
+                'train_model': transport.event(f'{name}/train_model')
+                }
+        self.data['namespace'] = self.namespace
+        self.data['topic'] = name
+        # Threads of the topic, set up in app.py
+        self.classifier = None
+        self.trainer = None
+        self.annotator = None
+        self.monitor = None
+        self.retention = None
+
+    @property
+    def threads(self):
+        return [self.monitor, self.classifier, self.trainer, self.retention,
+                self.annotator]
+
+    def matches(self, tokens):
+        '''
+        True if the status with the given set of lowercase tokens matches one
+        of the keywords. Like the Twitter API, a keyword phrase matches if all
+        of its words occur in the status.
+        '''
+        for keyword in self.keywords:
+            words = self._token_pattern.findall(keyword.lower())
+            if len(words) > 0 and all(w in tokens for w in words):
+                return True
+        return False
+
+
+def status_tokens(status):
+    '''Lowercase tokens of the text and entities of a `records.Status`'''
+    tokens = set(Topic._token_pattern.findall(status.text.lower()))
+    tokens.update(ht[0].lower() for ht in status.hashtags)
+    tokens.update(user[0].lower() for user in status.mentions)
+    for url in status.urls:
+        tokens.update(Topic._token_pattern.findall((url[1] or url[0]).lower()))
+    return tokens
+
+
+def route(status, topics):
+    '''
+    Topics a status belongs to. Statuses from the sample stream belong to all
+    topics. Track statuses belong to the topics whose keywords they match, or
+    to all topics if they match none (the API also matches on fields that are
+    not part of the status record, e.g. quoted statuses).
+
+    status: records.Status
+    topics: list of Topic
+    '''
+    if status['sample'] != 'track' or len(topics) == 1:
+        return topics
+    tokens = status_tokens(status)
+    matched = [topic for topic in topics if topic.matches(tokens)]
+    if len(matched) == 0:
+        return topics
+    return matched
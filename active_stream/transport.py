@@ -0,0 +1,326 @@
+import threading
+import queue
+
+from multiprocessing.managers import BaseManager, BaseProxy, DictProxy, \
+                                     EventProxy
+from gensim import corpora
+
+
+def put_latest(q, item):
+    '''
+    Put `item` into `q` without blocking. If the queue is full the oldest item
+    is dropped. Used for queues where only the latest item matters (models,
+    features, messages), so a slow or absent consumer never stalls the
+    producer.
+    '''
+    while True:
+        try:
+            q.put_nowait(item)
+            return
+        except queue.Full:
+            try:
+                q.get_nowait()
+            except queue.Empty:
+                pass
+
+
+class DictionaryService(object):
+    '''
+    Owner of the dictionary in distributed mode. All token ids are assigned
+    here, so all text processor workers map tokens to the same ids. Every
+    method holds a lock, so concurrent updates from several workers are
+    serialized.
+
+    Arguments:
+    ---------------
+    dictionary: gensim.corpora.Dictionary or None for an empty one
+    '''
+
+    def __init__(self, dictionary=None):
+        if dictionary is None:
+            dictionary = corpora.Dictionary()
+        self.dictionary = dictionary
+        self.lock = threading.Lock()
+
+    def doc2bow(self, document, allow_update=False):
+        '''Returns a tuple (bow, size of the dictionary after the update)'''
+        with self.lock:
+            bow = self.dictionary.doc2bow(document, allow_update=allow_update)
+            return bow, len(self.dictionary)
+
+    def size(self):
+        with self.lock:
+            return len(self.dictionary)
+
+    def num_docs(self):
+        with self.lock:
+            return self.dictionary.num_docs
+
+    def dfs(self):
+        with self.lock:
+            return dict(self.dictionary.dfs)
+
+    def tokens(self, ids):
+        with self.lock:
+            return [self.dictionary[i] for i in ids]
+
+    def save(self, path):
+        with self.lock:
+            self.dictionary.save(path)
+
+
+class SharedDictionary(object):
+    '''
+    Client side of a `DictionaryService`. Provides the part of the gensim
+    `Dictionary` interface the pipeline uses, so the threads work with either.
+
+    Arguments:
+    ---------------
+    service: DictionaryService or a proxy to it
+    '''
+
+    def __init__(self, service):
+        self.service = service
+
+    def doc2bow(self, document, allow_update=False):
+        bow, _ = self.service.doc2bow(document, allow_update)
+        return bow
+
+    def __len__(self):
+        return self.service.size()
+
+    def __getitem__(self, token_id):
+        return self.service.tokens([int(token_id)])[0]
+
+    @property
+    def num_docs(self):
+        return self.service.num_docs()
+
+    @property
+    def dfs(self):
+        return self.service.dfs()
+
+
+class ShardedQueue(object):
+    '''
+    Distributes items over several queues, one per consumer, by a key. Items
+    with the same key always go to the same consumer.
+
+    Arguments:
+    ---------------
+    queues: list of queues
+    key: callable, item -> int
+    '''
+
+    def __init__(self, queues, key):
+        self.queues = queues
+        self.key = key
+        self.maxsize = sum(q.maxsize for q in queues)
+
+    def shard(self, item):
+        return self.queues[self.key(item) % len(self.queues)]
+
+    def put(self, item, block=True, timeout=None):
+        self.shard(item).put(item, block, timeout)
+
+    def put_nowait(self, item):
+        self.shard(item).put_nowait(item)
+
+    def qsize(self):
+        return sum(q.qsize() for q in self.queues)
+
+    def empty(self):
+        return all(q.empty() for q in self.queues)
+
+
+class BroadcastQueue(object):
+    '''
+    Puts every item into several queues, one per consumer. Used to pass new
+    models to all classifier shards and prefilters to all text processor
+    workers. Puts never block: an item a consumer has not picked up yet is
+    replaced by the new one (see `put_latest()`).
+
+    Arguments:
+    ---------------
+    queues: list of queues
+    '''
+
+    def __init__(self, queues):
+        self.queues = queues
+
+    def put(self, item, block=True, timeout=None):
+        self.put_nowait(item)
+
+    def put_nowait(self, item):
+        for q in self.queues:
+            put_latest(q, item)
+
+    def get_nowait(self):
+        '''Remove pending items from all queues. Returns the last one'''
+        item = None
+        found = False
+        for q in self.queues:
+            try:
+                item = q.get_nowait()
+                found = True
+            except queue.Empty:
+                pass
+        if not found:
+            raise queue.Empty
+        return item
+
+    def qsize(self):
+        return max(q.qsize() for q in self.queues)
+
+    def empty(self):
+        return all(q.empty() for q in self.queues)
+
+
+class Broker(object):
+    '''
+    Registry of the named queues and events, the shared state and the
+    dictionary service. The stages look them up by name, so processes only
+    have to agree on names.
+
+    Arguments:
+    ---------------
+    dictionary: gensim.corpora.Dictionary or None for an empty one
+    '''
+
+    def __init__(self, dictionary=None):
+        self.lock = threading.Lock()
+        self.queues = {}
+        self.events = {}
+        self.shared_state = {}
+        self.dictionary_service = DictionaryService(dictionary)
+
+    def queue(self, name, maxsize=0):
+        '''The queue `name`. Created with `maxsize` on first use'''
+        with self.lock:
+            if name not in self.queues:
+                self.queues[name] = queue.Queue(maxsize)
+            return self.queues[name]
+
+    def event(self, name):
+        with self.lock:
+            if name not in self.events:
+                self.events[name] = threading.Event()
+            return self.events[name]
+
+    def get_state(self):
+        return self.shared_state
+
+    def get_dictionary(self):
+        return self.dictionary_service
+
+
+class LocalTransport(Broker):
+    '''
+    Transport for stages running as threads of one process. Queues, events
+    and the state are plain Python objects.
+    '''
+
+    def state(self):
+        return self.shared_state
+
+    def dictionary(self):
+        return self.dictionary_service
+
+
+class QueueProxy(BaseProxy):
+    '''Proxy to a `queue.Queue` in the broker process'''
+
+    _exposed_ = ('put', 'get', 'put_nowait', 'get_nowait', 'qsize', 'empty',
+                 'full', '__getattribute__')
+
+    def put(self, item, block=True, timeout=None):
+        return self._callmethod('put', (item, block, timeout))
+
+    def get(self, block=True, timeout=None):
+        return self._callmethod('get', (block, timeout))
+
+    def put_nowait(self, item):
+        return self._callmethod('put_nowait', (item,))
+
+    def get_nowait(self):
+        return self._callmethod('get_nowait')
+
+    def qsize(self):
+        return self._callmethod('qsize')
+
+    def empty(self):
+        return self._callmethod('empty')
+
+    def full(self):
+        return self._callmethod('full')
+
+    @property
+    def maxsize(self):
+        return self._callmethod('__getattribute__', ('maxsize',))
+
+
+class BrokerManager(BaseManager):
+    pass
+
+
+BrokerManager.register('queue', proxytype=QueueProxy)
+BrokerManager.register('event', proxytype=EventProxy)
+BrokerManager.register('state', proxytype=DictProxy)
+BrokerManager.register('dictionary')
+
+
+class SocketTransport(object):
+    '''
+    Transport for stages running in separate processes, possibly on
+    separate hosts. Connects to a broker started with `serve()`. Every queue
+    operation is a round trip to the broker, so items should be compact (see
+    `records.Status`).
+
+    Arguments:
+    ---------------
+    address: tuple (host, port) of the broker
+    authkey: bytes, shared secret of the broker
+    '''
+
+    def __init__(self, address, authkey):
+        self.manager = BrokerManager(address=address, authkey=authkey)
+        self.manager.connect()
+        self.queues = {}
+        self.events = {}
+
+    def queue(self, name, maxsize=0):
+        if name not in self.queues:
+            self.queues[name] = self.manager.queue(name, maxsize)
+        return self.queues[name]
+
+    def event(self, name):
+        if name not in self.events:
+            self.events[name] = self.manager.event(name)
+        return self.events[name]
+
+    def state(self):
+        return self.manager.state()
+
+    def dictionary(self):
+        return self.manager.dictionary()
+
+
+def serve(address, authkey, dictionary=None):
+    '''
+    Run a broker for `SocketTransport` clients. Blocks until the process is
+    terminated.
+
+    address: tuple (host, port) to listen on
+    authkey: bytes, shared secret clients have to present
+    dictionary: gensim.corpora.Dictionary or None for an empty one
+    '''
+    broker = Broker(dictionary)
+    BrokerManager.register('queue', callable=broker.queue,
+                           proxytype=QueueProxy)
+    BrokerManager.register('event', callable=broker.event,
+                           proxytype=EventProxy)
+    BrokerManager.register('state', callable=broker.get_state,
+                           proxytype=DictProxy)
+    BrokerManager.register('dictionary', callable=broker.get_dictionary)
+    manager = BrokerManager(address=address, authkey=authkey)
+    manager.get_server().serve_forever()
@@ -1,3 +1,6 @@
+import argparse
+import json
+import os
 import queue 
 import logging
 import sys
@@ -7,7 +10,7 @@ import Stemmer
 from pymongo import MongoClient
 from sklearn.linear_model import SGDClassifier
 from gensim import corpora
-from flask import Flask, render_template
+from flask import Flask, Response, abort, render_template, request
 from flask_socketio import SocketIO, emit
 
 # Custom imports
@@ -17,7 +20,17 @@ from annotation import Annotator
 from credentials import credentials
 from text_processing import TextProcessor
 from monitor import Monitor
-from classification import Classifier, Trainer
+from classification import Classifier, Trainer, Prefilter
+from features import FeaturePruner
+from snapshot import Snapshotter, load_dictionary
+from dedup import Deduplicator
+from admission import AdmissionController
+from retention import Retention
+from topics import Topic
+from transport import SocketTransport
+import distributed
+import export
+import profiling
 
 async_mode = 'threading'
 app = Flask(__name__)
@@ -26,91 +39,218 @@ socketio = SocketIO(app, async_mode=async_mode, logger=False)
 
 @app.route('/', methods=['GET', 'POST'])
 def index():
-    return render_template('index.html', async_mode=socketio.async_mode)
+    return topic_index(next(iter(data['topics'])))
 
-@socketio.on('tweet_relevant')
-def tweet_relevant():
+@app.route('/topic/<name>', methods=['GET', 'POST'])
+def topic_index(name):
+    if name not in data['topics']:
+        abort(404)
+    return render_template('index.html', async_mode=socketio.async_mode,
+                           topic=name, topics=list(data['topics']),
+                           namespace=data['topics'][name].namespace)
+
+@app.route('/export')
+def export_statuses():
+    '''
+    Stream statuses as NDJSON. Query parameters: topic (default: the first
+    topic), clf_version (int), relevant ('true' / 'false'), sample ('track' /
+    'sample'), and classified_at (float) and after (`_id`) of the last status
+    of a previous export to continue from. Statuses classified within the last
+    minute are left for the next export (see export.py).
+    '''
+    args = request.args
+    topic = data['topics'].get(args.get('topic', next(iter(data['topics']))))
+    if topic is None:
+        abort(404)
+    relevant = args.get('relevant')
+    if relevant is not None:
+        relevant = relevant.lower() == 'true'
+    query = export.build_query(clf_version=args.get('clf_version', type=int),
+                               relevant=relevant,
+                               sample=args.get('sample'))
+    after = None
+    if 'after' in args:
+        classified_at = args.get('classified_at', type=float)
+        if classified_at is None:
+            abort(400)
+        after = (classified_at, args['after'])
+    query = export.incremental_query(query, after=after,
+                                     until=time.time() - 60)
+    rows = export.iter_rows(topic.data['database'], query)
+    return Response((json.dumps(row) + '\n' for row in rows),
+                    mimetype='application/x-ndjson')
+
+profiling_lock = threading.Lock()
+max_profile_seconds = 300
+
+def profile_seconds(args):
+    '''Length of a profiling request. Clamped, the lock is held meanwhile'''
+    seconds = args.get('seconds', 10, type=float)
+    return min(max(seconds, 0), max_profile_seconds)
+
+@app.route('/profile')
+def profile():
+    '''
+    Sample the stacks of the worker threads and return them in collapsed
+    format (for flamegraph.pl or speedscope). Query parameters: seconds (at
+    most `max_profile_seconds`), interval (seconds between samples) and
+    threads (comma separated thread names, default all).
+    '''
+    args = request.args
+    seconds = profile_seconds(args)
+    threads = args.get('threads')
+    if threads is not None:
+        threads = threads.split(',')
+    if not profiling_lock.acquire(blocking=False):
+        return Response('Profiling already running\n', status=409,
+                        mimetype='text/plain')
+    try:
+        stacks = profiling.sample_stacks(seconds,
+                                         args.get('interval', 0.005,
+                                                  type=float),
+                                         thread_names=threads)
+    finally:
+        profiling_lock.release()
+    return Response(profiling.collapsed(stacks), mimetype='text/plain',
+                    headers={'Content-Disposition':
+                             'attachment; filename=profile.collapsed'})
+
+@app.route('/profile/memory')
+def profile_memory():
+    '''
+    Report allocation growth (tracemalloc) and the sizes of the shared data
+    structures over a time window. Query parameters: seconds (at most
+    `max_profile_seconds`) and top.
+    '''
+    args = request.args
+    seconds = profile_seconds(args)
+    if not profiling_lock.acquire(blocking=False):
+        return Response('Profiling already running\n', status=409,
+                        mimetype='text/plain')
+    try:
+        report = profiling.memory_growth(data, seconds,
+                                         top=args.get('top', 25, type=int))
+    finally:
+        profiling_lock.release()
+    return Response(report, mimetype='text/plain')
+
+def current_topic():
+    '''The topic of the namespace of the requesting client'''
+    return data['topics'][request.namespace[1:]]
+
+def annotation_response(response, message=None):
+    '''Pass a response of the requesting client on to the Annotator'''
+    if message is None:
+        message = {}
+    current_topic().data['queues']['annotation_response'].put(
+            {'session': request.sid,
+             'tweet_id': message.get('tweet_id'),
+             'response': response})
+
+def tweet_relevant(message=None):
     logging.debug('Received: tweet_relevant')
     emit('log', {'data': 'Connected'})
-    data['queues']['annotation_response'].put('relevant')
+    annotation_response('relevant', message)
 
-@socketio.on('tweet_irrelevant')
-def tweet_irrelevant():
+def tweet_irrelevant(message=None):
     logging.debug('Received: tweet_irrelevant')
-    data['queues']['annotation_response'].put('irrelevant')
+    annotation_response('irrelevant', message)
 
-@socketio.on('refresh')
-def refresh():
+def refresh(message=None):
     logging.debug('Received refresh')
-    data['queues']['annotation_response'].put('refresh')
+    annotation_response('refresh', message)
 
-@socketio.on('skip')
-def skip():
+def skip(message=None):
     logging.debug('Received skip')
-    data['queues']['annotation_response'].put('skip')
+    annotation_response('skip', message)
 
-@socketio.on('connect')
 def test_connect():
     global threads
     for t in threads:
         if not t.isAlive():
             t.start()
-    # Resend the 'wait' from annotator on re-connect
-    if threads[-1].isAlive(): # TODO: name threads
-        threads[-1].first = True
-    emit('keywords', {'keywords': list(streamer.keywords)})
+    # Open an annotation session for this client
+    annotation_response('connect')
+    topic = current_topic()
+    emit('keywords', {'keywords': list(topic.keywords)})
+    emit('history', {'data': topic.monitor.timeseries.history()})
+
+def disconnect():
+    logging.debug('Client disconnected')
+    annotation_response('disconnect')
 
-@socketio.on('disconnect_request')
 def test_disconnect():
-    global annotator
-    logging.info('Stopping Annotator.')
-    annotator.join()
+    topic = current_topic()
+    logging.info(f'Stopping Annotator ({topic.name}).')
+    topic.annotator.join()
 
-@socketio.on('add_keyword')
 def add_keyword(message):
     logging.debug('Received request to add new keyword. Sending to Streamer.')
-    data['queues']['keywords'].put({'add': True, 'word': message['data']})
+    data['queues']['keywords'].put({'add': True, 'word': message['data'],
+                                    'topic': current_topic().name})
 
-@socketio.on('remove_keyword')
 def remove_keyword(message):
     logging.debug('Received request to remove keyword. Sending to Streamer.')
-    data['queues']['keywords'].put({'add': False, 'word': message['data']})
+    data['queues']['keywords'].put({'add': False, 'word': message['data'],
+                                    'topic': current_topic().name})
+
+# Socket.IO event handlers, registered for the namespace of every topic
+socket_events = {
+        'tweet_relevant': tweet_relevant,
+        'tweet_irrelevant': tweet_irrelevant,
+        'refresh': refresh,
+        'skip': skip,
+        'connect': test_connect,
+        'disconnect': disconnect,
+        'disconnect_request': test_disconnect,
+        'add_keyword': add_keyword,
+        'remove_keyword': remove_keyword
+        }
 
 if __name__ == '__main__':
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--resume', action='store_true',
+                        help='Resume the last session from its snapshot '
+                             'instead of starting a new collection')
+    parser.add_argument('--distributed', metavar='BROKER',
+                        help='Connect to the broker at host:port and only run '
+                             'the web interface, see '
+                             'active_stream/distributed.py')
+    parser.add_argument('--authkey', default=None,
+                        help='Shared secret of the broker. Defaults to the '
+                             'environment variable ACTIVE_STREAM_AUTHKEY')
+    args = parser.parse_args()
+
     # =========================================================================== 
     # Config
     # =========================================================================== 
     BUF_SIZE = 1000                # Maximum size
     db = 'active_stream'          # Mongo Database name
-    collection = 'dump'           # Mongo db collection name
+    topic_collections = {          # Topic name -> Mongo db collection name
+            'default': 'dump'
+            }
     filters = {'languages': ['en']}
     n_before_train = 10
+    annotation_lease = 120         # Seconds before unanswered leases expire
+    snapshot_dir = 'snapshots'     # Directory for session snapshots
+    snapshot_interval = 60         # Seconds between snapshots
+    dedup_capacity = 100000        # Duplicate clusters kept in memory
+    prefilter_threshold = 0.05     # Skip NLP below this prob. None to disable
+    prefilter_explore = 0.01       # Share of skipped statuses processed anyway
+    shedding_policy = 'uniform'    # 'uniform', 'priority' or 'retweets'
+    prune_no_below = 2             # Drop tokens in fewer statuses from model
+    prune_no_above = 0.5           # Drop tokens in larger share of statuses
+    archive_dir = 'archive'        # Compressed raw statuses of compacted docs
+    retention = {                  # Seconds / counts, None to disable
+            'sample_ttl': 24 * 3600,
+            'max_sample': None,
+            'irrelevant_ttl': 3 * 24 * 3600,
+            'irrelevant_threshold': 0.05,
+            'compact_after': 6 * 3600
+            }
     # =========================================================================== 
     
-    # Set up data structures
-    data = {
-            'database': MongoClient()[db][collection],
-            'queues': {
-                'text_processing': queue.Queue(BUF_SIZE),
-                'model': queue.Queue(1),
-                'annotation_response': queue.Queue(1),
-                'most_important_features': queue.Queue(1),
-                'keywords': queue.Queue(BUF_SIZE),
-                'limit': queue.Queue(BUF_SIZE),
-                'messages': queue.Queue(BUF_SIZE)
-                },
-            'dictionary': corpora.Dictionary(),
-            'events': {
-                'train_model': threading.Event()
-                },
-            'filters': filters,
-            'socket': socketio,
-            }
-
-    # Clear database
-    data['database'].drop()
-
     # Set up logging
     logging.basicConfig(level=logging.DEBUG,
                     format='%(asctime)s (%(threadName)s) %(message)s',
@@ -124,20 +264,120 @@ if __name__ == '__main__':
     logging.getLogger('socketio').setLevel(logging.ERROR)
     logging.getLogger('werkzeug').setLevel(logging.ERROR)
 
-    # Initialize Threads
-    streamer = Streamer(credentials_track=credentials['coll_1'],
-                        credentials_sample=credentials['main_account'], 
-                        data=data)
-    text_processor = TextProcessor(data)
-    annotator = Annotator(train_threshold=n_before_train, data=data)
-    classifier = Classifier(data)
-    monitor = Monitor(streamer=streamer, classifier=classifier, 
-                      annotator=annotator, data=data)
-    trainer = Trainer(data=data, streamer=streamer,
-                      clf=SGDClassifier(loss='log', penalty='l1', 
-                                        alpha=0.001))
-
-    threads = [streamer, text_processor, monitor, classifier, trainer, 
-               annotator]
+    if args.distributed:
+        # Streamer, text processing, classification and training run in
+        # separate processes (see active_stream/distributed.py). This process
+        # runs the web interface, Annotators, Monitors and Retention
+        if args.resume:
+            parser.error('--resume is not supported with --distributed')
+        try:
+            authkey = distributed.get_authkey(args.authkey)
+        except ValueError as e:
+            parser.error(str(e))
+        transport = SocketTransport(
+                distributed.parse_address(args.distributed), authkey)
+        data = distributed.build_data(transport, db, topic_collections,
+                                      BUF_SIZE, filters=filters,
+                                      socket=socketio)
+        state = transport.state()
+        streamer = distributed.StreamerState(state, data['topics'])
+    else:
+        # Set up data structures
+        if args.resume:
+            dictionary = load_dictionary(snapshot_dir)
+        else:
+            dictionary = corpora.Dictionary()
+
+        # Shared by all topics. The topic specific data structures (database,
+        # model queues, annotation queues, ...) are in `topic.data`, see
+        # topics.Topic
+        data = {
+                'queues': {
+                    'text_processing': queue.Queue(BUF_SIZE),
+                    'keywords': queue.Queue(BUF_SIZE),
+                    'limit': queue.Queue(BUF_SIZE)
+                    },
+                'dictionary': dictionary,
+                'locks': {
+                    'dictionary': threading.Lock()
+                    },
+                'filters': filters,
+                'socket': socketio,
+                }
+        data['admission'] = AdmissionController(policy=shedding_policy)
+        data['topics'] = {}
+        for name, collection in topic_collections.items():
+            topic = Topic(name, data, MongoClient()[db][collection], BUF_SIZE)
+            data['topics'][name] = topic
+
+            # Clear database
+            if not args.resume:
+                topic.data['database'].drop()
+            topic.data['database'].create_index('id')
+            topic.data['database'].create_index('duplicate_of')
+            topic.data['database'].create_index([('classified_at', 1), ('_id', 1)])
+
+        # Initialize Threads
+        streamer = Streamer(credentials_track=credentials['coll_1'],
+                            credentials_sample=credentials['main_account'], 
+                            data=data)
+        text_processor = TextProcessor(
+                data, deduplicator=Deduplicator(capacity=dedup_capacity))
+
+    for topic in data['topics'].values():
+        if args.distributed:
+            topic.classifier = distributed.ClassifierState(state, topic.name)
+        else:
+            topic.classifier = Classifier(topic.data)
+        topic.annotator = Annotator(train_threshold=n_before_train,
+                                    data=topic.data,
+                                    lease_timeout=annotation_lease)
+        topic.retention = Retention(data=topic.data,
+                                    archive_dir=os.path.join(archive_dir,
+                                                             topic.name),
+                                    **retention)
+        topic.monitor = Monitor(streamer=streamer,
+                                classifier=topic.classifier,
+                                annotator=topic.annotator,
+                                retention=topic.retention, data=topic.data)
+        if not args.distributed:
+            if prefilter_threshold is not None:
+                prefilter = Prefilter(threshold=prefilter_threshold,
+                                      explore=prefilter_explore)
+            else:
+                prefilter = None
+            topic.trainer = Trainer(
+                    data=topic.data, streamer=streamer,
+                    clf=SGDClassifier(loss='log', penalty='l1', alpha=0.001),
+                    prefilter=prefilter,
+                    pruner=FeaturePruner(topic.data, no_below=prune_no_below,
+                                         no_above=prune_no_above))
+
+        for event, handler in socket_events.items():
+            socketio.on_event(event, handler, namespace=topic.namespace)
+
+    if args.distributed:
+        threads = [distributed.StateSync(
+            distributed.keyword_sync(state, data['topics']))]
+        for topic in data['topics'].values():
+            threads.extend([topic.monitor, topic.retention, topic.annotator])
+    else:
+        snapshotter = Snapshotter(data=data, streamer=streamer,
+                                  text_processor=text_processor,
+                                  topics=list(data['topics'].values()),
+                                  directory=snapshot_dir,
+                                  interval=snapshot_interval)
+
+        if args.resume:
+            snapshotter.restore()
+            # Statuses processed after the dictionary snapshot hold token ids
+            # the restored dictionary does not know about
+            text_processor.reprocess({'dict_size': {'$gt': len(dictionary)},
+                                      'bow': {'$ne': None},
+                                      'compacted': {'$ne': True}})
+
+        threads = [streamer, text_processor, snapshotter]
+        for topic in data['topics'].values():
+            threads.extend(topic.threads)
 
     socketio.run(app, debug=False)
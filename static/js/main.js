@@ -11,8 +11,11 @@ $(document).ready(function() {
     //     http[s]://<domain>:<port>[/<namespace>]
     //var socket = io.connect(location.protocol + '//' + document.domain + ':' + 
     //                        location.port);
-    var socket = io.connect(null, {port: 8000, rememberTransport: false});
+    // Each topic has its own namespace (set by the template)
+    var socket = io.connect(namespace, {port: 8000, rememberTransport: false});
     var messages = []; 
+    // Id of the tweet currently leased to this client for annotation
+    var current_tweet_id = null;
 
     socket.emit('refresh');
     // Display active keywords
@@ -41,6 +44,7 @@ $(document).ready(function() {
         }
        
         if(msg['tweet_id'] == 'waiting') {
+            current_tweet_id = null;
             loader = document.createElement('div');
             loader.classList.add("loader");
             loader.classList.add("center-block");
@@ -56,6 +60,7 @@ $(document).ready(function() {
             tweet.setAttribute('id', 'tweet');
             tweet_container.appendChild(tweet);
             var id = msg['tweet_id'];
+            current_tweet_id = id;
             var guess = msg['guess'];
             var eval_run = (msg['eval'] === 'True');
             console.log(msg);
@@ -105,11 +110,18 @@ $(document).ready(function() {
         return(false);
     });
 
+    // History of the monitor stats, picked up by the rate graph
+    socket.on("history", function(msg) {
+        console.log('Received stats history');
+        monitor_history = msg["data"];
+    });
+
     socket.on("db_report", function(msg) {
         monitor_data = msg["data"];
         var data = monitor_data;
         $("#total").html(data["total_count"]);
-        $("#missed").html(data["missed"]);
+        $("#missed").html(data["missed"] + " / " + data["shed"] + " / " +
+                          data["overflow"]);
         $("#annotated").html(data["annotated"]);
         $("#classified").html(data["classified"]);
         var suggestions = data["suggested_features"];
@@ -137,15 +149,15 @@ $(document).ready(function() {
     // These accept data from the user and send it to the server in a
     // variety of ways
     $("button#relevant").on('click', function() {
-        socket.emit("tweet_relevant");
+        socket.emit("tweet_relevant", {tweet_id: current_tweet_id});
     });
     $("button#irrelevant").on('click', function() {
-        socket.emit("tweet_irrelevant");
+        socket.emit("tweet_irrelevant", {tweet_id: current_tweet_id});
     });
     $("button#skip").on('click', function() {
-        socket.emit("skip");
+        socket.emit("skip", {tweet_id: current_tweet_id});
     });
     $("button#refresh").on('click', function() {
-        socket.emit("refresh");
+        socket.emit("refresh", {tweet_id: current_tweet_id});
     });
 });
@@ -1,6 +1,8 @@
 // Adapted from Simen Brekken
 // http://bl.ocks.org/simenbrekken/6634070
 var monitor_data = null;
+// Stats history sent by the server on connect
+var monitor_history = null;
 $(document).ready(function() {
 
     var limit = 60 * 2,
@@ -88,6 +90,18 @@ $(document).ready(function() {
         //}
         var group = groups['rate'];
 
+        // Fill the graph with the 1 second history from the server
+        if (monitor_history != null) {
+            var history = monitor_history['1']['rate'].slice(-limit);
+            monitor_history = null;
+            var values = d3.range(limit - history.length).map(function() {
+                return 0
+            }).concat(history.map(function(v) {
+                return v == null ? 0 : v
+            }));
+            group.data.splice.apply(group.data, [0, limit].concat(values));
+        }
+
         if (monitor_data != null) {
             group.data.push(monitor_data['rate']);
             max_rate = Math.max.apply(Math, group.data);
@@ -0,0 +1,72 @@
+import sys
+
+sys.path.append('active_stream/')
+
+import numpy as np
+import pytest
+
+import admission
+from admission import AdmissionController
+from records import Status
+
+
+def make_status(i, text='some status text', retweeted_id=None):
+    status = Status(i, text, 'user', 'User', retweeted_id=retweeted_id)
+    status['sample'] = 'track'
+    return status
+
+
+@pytest.mark.parametrize('load, expected', [(0.9, 1.0), (1.1, 1 / 1.1),
+                                            (2, 0.5)])
+def test_keep_probability(load, expected):
+    controller = AdmissionController()
+    assert controller.keep_probability(make_status(1), load) == \
+        pytest.approx(expected)
+
+
+def test_keep_probability_policies():
+    controller = AdmissionController(policy='priority')
+    controller.set_priority_tokens(['flu'], 'a')
+    assert controller.keep_probability(make_status(1, 'flu shot'), 2) == 1.0
+    assert controller.keep_probability(make_status(2), 2) == 0.5
+
+    controller = AdmissionController(policy='retweets')
+    retweet = make_status(3, retweeted_id=1)
+    assert controller.keep_probability(retweet, 2) == pytest.approx(0.25)
+    assert controller.keep_probability(make_status(4), 2) == \
+        pytest.approx(np.sqrt(0.5))
+
+
+@pytest.mark.parametrize('load', [0.9, 1.1, 2])
+def test_admit_keeps_pipeline_at_capacity(monkeypatch, load):
+    '''Statuses arrive every second and take `load` seconds to process'''
+    clock = [0.0]
+    monkeypatch.setattr(admission, 'time', lambda: clock[0])
+    np.random.seed(0)
+    controller = AdmissionController()
+
+    admitted = []
+    loads = []
+    for i in range(6000):
+        clock[0] += 1
+        status = make_status(i)
+        if controller.admit(status):
+            controller.observe_latency(load)
+            admitted.append(status)
+        elif i >= 1000:
+            assert status.get('sampling_weight') is None
+        if i >= 1000:
+            loads.append(controller.load())
+
+    steady = [s for s in admitted if s.id >= 1000]
+    kept = len(steady) / 5000
+    if load < 1:
+        assert kept == 1.0
+        assert controller.shed['track'] == 0
+    else:
+        assert kept == pytest.approx(1 / load, abs=0.05)
+        # Shedding does not hide the overload from the estimate
+        assert np.mean(loads) == pytest.approx(load, rel=0.1)
+        # Weighted counts estimate the number of arrivals
+        weights = sum(s['sampling_weight'] for s in steady)
+        assert weights == pytest.approx(5000, rel=0.05)
@@ -0,0 +1,93 @@
+import sys
+
+sys.path.append('active_stream/')
+
+from dedup import Deduplicator
+from records import Status
+
+long_text = ('the health department says the new flu vaccine is now '
+             'available at all pharmacies in the city and recommends that '
+             'everyone over sixty gets a shot before the winter season starts '
+             'next month')
+
+
+def make_status(i, text, retweeted_id=None):
+    return Status(i, text, 'user', 'User', retweeted_id=retweeted_id)
+
+
+def add(dedup, status):
+    '''Register `status` as processed canonical status'''
+    status['bow'] = [(0, 1)]
+    status['dict_size'] = 1
+    dedup.add(dedup.signature(status), status)
+
+
+def match(dedup, status):
+    cluster = dedup.match(dedup.signature(status))
+    return None if cluster is None else cluster['id']
+
+
+def test_retweet_matches_by_retweeted_id():
+    dedup = Deduplicator()
+    add(dedup, make_status(1, 'hi there'))
+    assert match(dedup, make_status(2, 'hi there', retweeted_id=1)) == 1
+    # Two retweets of the same original status
+    add(dedup, make_status(3, 'something else', retweeted_id=100))
+    assert match(dedup, make_status(4, 'unrelated', retweeted_id=100)) == 3
+
+
+def test_exact_match_after_normalization():
+    dedup = Deduplicator()
+    add(dedup, make_status(1, 'Flu shots available now at http://t.co/abc '
+                              'your pharmacy'))
+    copy = make_status(2, 'RT @someone: flu SHOTS available now at '
+                          'https://t.co/xyz your pharmacy')
+    assert match(dedup, copy) == 1
+
+
+def test_near_duplicate_above_threshold():
+    dedup = Deduplicator()
+    add(dedup, make_status(1, long_text))
+    near = make_status(2, long_text.replace('next month', 'next week'))
+    assert match(dedup, near) == 1
+
+
+def test_dissimilar_text_below_threshold():
+    dedup = Deduplicator()
+    add(dedup, make_status(1, long_text))
+    words = long_text.split()
+    # Same words, half of them in a different order
+    half = len(words) // 2
+    different = make_status(2, ' '.join(words[:half] + words[half:][::-1]))
+    assert match(dedup, different) is None
+    assert match(dedup, make_status(3, 'election results are coming in '
+                                       'from all districts tonight')) is None
+
+
+def test_short_texts_only_match_by_id():
+    dedup = Deduplicator(min_tokens=4)
+    short = make_status(1, 'flu shot today')
+    keys, minhash = dedup.signature(short)
+    assert minhash is None
+    assert all(key[0] == 'id' for key in keys)
+    add(dedup, short)
+    assert match(dedup, make_status(2, 'flu shot today')) is None
+    assert match(dedup, make_status(3, 'flu shot today', retweeted_id=1)) == 1
+
+
+def test_lru_eviction_removes_index_keys():
+    dedup = Deduplicator(capacity=2)
+    texts = ['first status about the flu vaccine campaign',
+             'second status about the election results tonight',
+             'third status about the football game yesterday']
+    add(dedup, make_status(1, texts[0]))
+    add(dedup, make_status(2, texts[1]))
+    # Matching marks a cluster as recently used, so 2 is evicted next
+    assert match(dedup, make_status(10, texts[0])) == 1
+    add(dedup, make_status(3, texts[2]))
+
+    assert list(dedup.clusters) == [1, 3]
+    assert 2 not in dedup.index.values()
+    assert match(dedup, make_status(11, texts[1])) is None
+    assert match(dedup, make_status(12, 'x', retweeted_id=2)) is None
+    assert match(dedup, make_status(13, texts[2])) == 3
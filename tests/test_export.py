@@ -0,0 +1,87 @@
+import json
+import os
+import sys
+
+sys.path.append('active_stream/')
+
+import pytest
+
+from bson import ObjectId
+
+import export
+
+mongomock = pytest.importorskip('mongomock')
+
+
+@pytest.fixture
+def database():
+    return mongomock.MongoClient().db.statuses
+
+
+def insert(database, classified_at, _id=None, **fields):
+    doc = {'id': 1, 'text': 'text', 'clf_version': 1,
+           'classifier_relevant': True, 'manual_relevant': None,
+           'probability_relevant': 0.9, 'sample': 'track',
+           'classified_at': classified_at}
+    doc.update(fields)
+    if _id is not None:
+        doc['_id'] = _id
+    return database.insert_one(doc).inserted_id
+
+
+def test_incremental_query_boundary(database):
+    ids = sorted(ObjectId() for _ in range(4))
+    insert(database, 1.0, ids[3])
+    insert(database, 2.0, ids[0])
+    checkpoint = insert(database, 2.0, ids[1])
+    insert(database, 2.0, ids[2])
+    later = insert(database, 3.0, ObjectId())
+    insert(database, 10.0, ObjectId())
+
+    query = export.incremental_query(export.build_query(relevant=True),
+                                     after=(2.0, str(checkpoint)), until=10.0)
+    rows = list(export.iter_rows(database, query))
+    # At the same classification time only larger _ids follow. The upper
+    # bound is exclusive
+    assert [(r['classified_at'], r['_id']) for r in rows] == \
+        [(2.0, str(ids[2])), (3.0, str(later))]
+
+
+def test_incremental_query_keeps_filters(database):
+    insert(database, 5.0, classifier_relevant=False)
+    insert(database, 5.0)
+    query = export.incremental_query(export.build_query(relevant=True),
+                                     after=(1.0, str(ObjectId())))
+    assert [r['classifier_relevant']
+            for r in export.iter_rows(database, query)] == [True]
+
+
+def test_to_row_maps_missing_classification_to_none():
+    status = {'_id': ObjectId(), 'id': 1, 'text': 'text',
+              'manual_relevant': -1, 'clf_version': float('inf')}
+    row = export.to_row(status)
+    assert row['manual_relevant'] is None
+    assert row['clf_version'] is None
+    assert row['_id'] == str(status['_id'])
+    assert row['probability_relevant'] is None
+
+    row = export.to_row(dict(status, manual_relevant=True, clf_version=3))
+    assert row['manual_relevant'] is True
+    assert row['clf_version'] == 3
+
+
+def test_export_continues_and_refuses_other_query(database, tmpdir):
+    out_dir = str(tmpdir)
+    for t in range(3):
+        insert(database, float(t))
+    query = export.build_query(clf_version=1, relevant=True)
+    assert export.export(database, out_dir, query, chunk_size=2) == 3
+    assert export.export(database, out_dir, query) == 0
+
+    with open(os.path.join(out_dir, export.state_file)) as infile:
+        state = json.load(infile)
+    assert state['query'] == query
+    assert state['classified_at'] == 2.0
+
+    with pytest.raises(ValueError):
+        export.export(database, out_dir, export.build_query(clf_version=2))
@@ -0,0 +1,73 @@
+import sys
+import threading
+
+sys.path.append('active_stream/')
+
+import numpy as np
+
+from gensim import corpora
+from features import FeatureMap, FeaturePruner
+
+
+def test_transform_ignores_dropped_and_unknown_ids():
+    # Dictionary id 1 is dropped, ids >= 3 were added after the map
+    feature_map = FeatureMap(0, np.array([1, -1, 0]))
+    assert feature_map.n_features == 2
+
+    corpus = [[(0, 2), (1, 1), (5, 3)], [], [(2, 1), (3, 4)]]
+    X = feature_map.transform(corpus)
+    assert X.shape == (3, 2)
+    assert X.toarray().tolist() == [[0, 2], [0, 0], [1, 0]]
+
+
+def test_transform_empty_corpus():
+    feature_map = FeatureMap(0, np.array([0, 1, -1]))
+    assert feature_map.transform([]).shape == (0, 2)
+    X = feature_map.transform([[], [(2, 1)]])
+    assert X.shape == (2, 2)
+    assert X.nnz == 0
+
+
+def make_pruner(documents, **kwargs):
+    dictionary = corpora.Dictionary(documents)
+    data = {'dictionary': dictionary,
+            'locks': {'dictionary': threading.Lock()}}
+    return dictionary, FeaturePruner(data, **kwargs)
+
+
+def test_pruner_selects_ids_by_document_frequency():
+    # common: all 10 statuses, rare: 1, mid: 3, half: 5
+    documents = [['common'] for _ in range(10)]
+    documents[0].append('rare')
+    for doc in documents[:3]:
+        doc.append('mid')
+    for doc in documents[:5]:
+        doc.append('half')
+    dictionary, pruner = make_pruner(documents, no_below=2, no_above=0.5)
+
+    feature_map = pruner.update()
+    kept = [dictionary[i] for i in feature_map.ids]
+    assert sorted(kept) == ['half', 'mid']
+    assert len(feature_map.index) == len(dictionary)
+    # Columns follow the order of the dictionary ids
+    assert feature_map.index[feature_map.ids].tolist() == [0, 1]
+    assert feature_map.index[dictionary.token2id['common']] == -1
+
+
+def test_pruner_recomputes_after_min_growth():
+    documents = [['a', 'b'], ['a', 'c'], ['b', 'c']] * 10
+    dictionary, pruner = make_pruner(documents, no_below=2, no_above=1,
+                                     min_growth=0.1)
+    first = pruner.update()
+    assert first.version == 0
+    assert first.n_features == 3
+
+    # 30 statuses, a new map is only computed from 33 on
+    dictionary.add_documents([['d', 'e']] * 2)
+    assert pruner.update() is first
+
+    dictionary.add_documents([['d', 'e']])
+    second = pruner.update()
+    assert second.version == 1
+    assert second.n_features == 5
+    assert pruner.update() is second
@@ -0,0 +1,131 @@
+import multiprocessing
+import queue
+import socket
+import sys
+import time
+
+sys.path.append('active_stream/')
+
+import pytest
+
+from transport import serve, SocketTransport, ShardedQueue, BroadcastQueue, \
+                      SharedDictionary, put_latest
+
+authkey = b'test secret'
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture(scope='module')
+def address():
+    '''A broker in a subprocess, as run by `distributed.py broker`'''
+    address = ('127.0.0.1', free_port())
+    broker = multiprocessing.get_context('spawn').Process(
+            target=serve, args=(address, authkey), daemon=True)
+    broker.start()
+    deadline = time.time() + 30
+    while True:
+        try:
+            SocketTransport(address, authkey)
+            break
+        except (ConnectionRefusedError, EOFError):
+            if time.time() > deadline:
+                raise
+            time.sleep(0.1)
+    yield address
+    broker.terminate()
+    broker.join()
+
+
+def test_wrong_authkey_is_refused(address):
+    with pytest.raises(multiprocessing.AuthenticationError):
+        SocketTransport(address, b'wrong secret')
+
+
+def test_queue_proxy(address):
+    producer = SocketTransport(address, authkey)
+    consumer = SocketTransport(address, authkey)
+    q = producer.queue('queue', 2)
+    assert q.maxsize == 2
+    # The queue is created on first use, later lookups get the same queue
+    assert consumer.queue('queue').maxsize == 2
+
+    q.put_nowait('a')
+    q.put('b')
+    assert q.full()
+    with pytest.raises(queue.Full):
+        q.put_nowait('c')
+    assert consumer.queue('queue').qsize() == 2
+    assert consumer.queue('queue').get_nowait() == 'a'
+    assert consumer.queue('queue').get(True, 1) == 'b'
+    with pytest.raises(queue.Empty):
+        consumer.queue('queue').get_nowait()
+    assert q.empty()
+
+
+def test_sharded_queue(address):
+    transport = SocketTransport(address, authkey)
+    shards = [transport.queue(f'text_processing/{i}', 2) for i in range(2)]
+    sharded = ShardedQueue(shards, key=lambda item: item)
+    assert sharded.maxsize == 4
+
+    for i in range(4):
+        sharded.put_nowait(i)
+    with pytest.raises(queue.Full):
+        sharded.put_nowait(4)
+    assert sharded.qsize() == 4
+
+    worker = SocketTransport(address, authkey)
+    assert [worker.queue('text_processing/1').get_nowait()
+            for _ in range(2)] == [1, 3]
+
+
+def test_broadcast_queue_and_put_latest(address):
+    trainer = SocketTransport(address, authkey)
+    broadcast = BroadcastQueue([trainer.queue(f'model/{i}', 1)
+                                for i in range(2)])
+    shard = SocketTransport(address, authkey).queue('model/0')
+
+    broadcast.put('v1')
+    assert shard.get_nowait() == 'v1'
+    # Shard 1 has not picked up v1, the put must not block
+    broadcast.put('v2')
+    assert broadcast.get_nowait() == 'v2'
+    with pytest.raises(queue.Empty):
+        broadcast.get_nowait()
+
+    messages = trainer.queue('messages', 2)
+    for message in ['a', 'b', 'c']:
+        put_latest(messages, message)
+    assert [messages.get_nowait(), messages.get_nowait()] == ['b', 'c']
+
+
+def test_event_and_state(address):
+    web = SocketTransport(address, authkey)
+    trainer = SocketTransport(address, authkey)
+    assert not trainer.event('train_model').is_set()
+    web.event('train_model').set()
+    assert trainer.event('train_model').wait(1)
+    trainer.event('train_model').clear()
+    assert not web.event('train_model').is_set()
+
+    web.state()['missed'] = 3
+    trainer.state()['default/clf_version/0'] = 2
+    assert trainer.state().get('missed') == 3
+    assert dict(web.state())['default/clf_version/0'] == 2
+
+
+def test_shared_dictionary(address):
+    workers = [SharedDictionary(SocketTransport(address, authkey).dictionary())
+               for _ in range(2)]
+    bow = workers[0].doc2bow(['flu', 'shot', 'flu'], allow_update=True)
+    assert dict(bow)[workers[1].doc2bow(['flu'])[0][0]] == 2
+    assert workers[1].doc2bow(['shot', 'flu', 'flu']) == bow
+    assert sorted(workers[1][i] for i, _ in bow) == ['flu', 'shot']
+    assert len(workers[1]) == 2
+    assert workers[1].num_docs == 1
+    assert set(workers[1].dfs.values()) == {1}
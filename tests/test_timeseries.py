@@ -0,0 +1,49 @@
+import json
+import sys
+
+sys.path.append('active_stream/')
+
+from timeseries import RingBuffer, TimeSeries
+
+
+def test_ring_buffer_wraparound():
+    buf = RingBuffer(3, 1)
+    timestamps, values = buf.get()
+    assert len(timestamps) == 0
+
+    for t in range(3):
+        buf.append(t, [t * 10])
+    assert buf.get()[0].tolist() == [0, 1, 2]
+
+    # Overwrites the oldest observations, still ordered oldest first
+    for t in range(3, 8):
+        buf.append(t, [t * 10])
+        timestamps, values = buf.get()
+        assert timestamps.tolist() == [t - 2, t - 1, t]
+        assert values[:, 0].tolist() == [(t - 2) * 10, (t - 1) * 10, t * 10]
+
+
+def test_time_series_buckets():
+    series = TimeSeries(['a', 'b'], resolutions=((1, 3), (10, 2)))
+    series.add(0.2, {'a': 1})
+    series.add(0.7, {'a': 3, 'b': None})
+    # Nothing is recorded until a bucket is complete
+    assert series.history()['1']['time'] == []
+    series.add(1.5, {'a': 5, 'b': 2})
+    series.add(12, {'a': 7, 'b': 4})
+
+    history = series.history()
+    # Only completed buckets: the 12 s bucket and the 10 s bucket starting
+    # at 10 are still open
+    assert history['1'] == {'time': [0, 1], 'a': [2, 5], 'b': [None, 2]}
+    assert history['10'] == {'time': [0], 'a': [3], 'b': [2]}
+    json.dumps(history)
+
+
+def test_time_series_keeps_last_buckets():
+    series = TimeSeries(['a'], resolutions=((1, 3), (10, 2)))
+    for t in range(40):
+        series.add(t, {'a': t})
+    history = series.history()
+    assert history['1'] == {'time': [36, 37, 38], 'a': [36, 37, 38]}
+    assert history['10'] == {'time': [10, 20], 'a': [14.5, 24.5]}
@@ -0,0 +1,70 @@
+import queue
+import sys
+
+sys.path.append('active_stream/')
+
+import pytest
+
+from gensim import corpora
+from transport import LocalTransport, ShardedQueue, BroadcastQueue, \
+                      SharedDictionary, put_latest
+
+
+def test_sharded_queue_round_trip():
+    transport = LocalTransport()
+    shards = [transport.queue(f'text_processing/{i}', 2) for i in range(3)]
+    sharded = ShardedQueue(shards, key=lambda item: item['id'])
+    assert sharded.maxsize == 6
+
+    for i in range(6):
+        sharded.put_nowait({'id': i})
+    assert sharded.qsize() == 6
+    with pytest.raises(queue.Full):
+        sharded.put_nowait({'id': 0})
+
+    # Items with the same key end up with the same consumer
+    for i, q in enumerate(shards):
+        assert transport.queue(f'text_processing/{i}') is q
+        assert [q.get_nowait()['id'] for _ in range(2)] == [i, i + 3]
+    assert sharded.empty()
+
+
+def test_broadcast_queue_replaces_pending_items():
+    transport = LocalTransport()
+    consumers = [transport.queue(f'model/{i}', 1) for i in range(2)]
+    broadcast = BroadcastQueue(consumers)
+
+    broadcast.put('v1')
+    assert consumers[0].get_nowait() == 'v1'
+    # Consumer 1 has not picked up v1, the put must not block
+    broadcast.put('v2')
+    assert [q.get_nowait() for q in consumers] == ['v2', 'v2']
+    assert broadcast.empty()
+
+    broadcast.put('v3')
+    assert broadcast.get_nowait() == 'v3'
+    with pytest.raises(queue.Empty):
+        broadcast.get_nowait()
+
+
+def test_put_latest_never_blocks():
+    q = LocalTransport().queue('messages', 2)
+    for message in ['a', 'b', 'c']:
+        put_latest(q, message)
+    assert [q.get_nowait(), q.get_nowait()] == ['b', 'c']
+
+
+def test_shared_dictionary_round_trip():
+    transport = LocalTransport(corpora.Dictionary([['existing']]))
+    workers = [SharedDictionary(transport.dictionary()) for _ in range(2)]
+
+    bow = workers[0].doc2bow(['new', 'existing', 'new'], allow_update=True)
+    assert workers[1].doc2bow(['existing', 'new', 'new']) == bow
+    assert sorted(workers[1][i] for i, _ in bow) == ['existing', 'new']
+    assert len(workers[1]) == 2
+    assert workers[1].num_docs == 2
+    assert workers[1].dfs == {i: 2 if workers[1][i] == 'existing' else 1
+                              for i, _ in bow}
+    # Without allow_update unknown tokens are ignored
+    assert workers[1].doc2bow(['unknown']) == []
+    assert len(workers[0]) == 2